@@ -27,5 +27,5 @@ setup(
     ],
 
     packages=find_packages(exclude=['examples', 'bin']),
-    scripts=['bin/skytracker']
+    scripts=['bin/skytracker', 'bin/skytracker_batch', 'bin/skytracker_benchmark']
 )
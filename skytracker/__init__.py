@@ -2,6 +2,8 @@ from .skytracker import *
 from .cmd_line_app import app_main
 from .blob_data_tools import *
 from .track_tools import *
+from .track import *
+from .track_store import *
 from .frame_stepper import *
 
 __version__ = '0.0.1'
@@ -0,0 +1,232 @@
+from __future__ import print_function
+import cv2
+import numpy as np
+
+from median_background import MedianBackground
+
+
+class RunningMedianBackground(MedianBackground):
+    """
+    Approximate median background model which keeps only the background image: on
+    each update every background pixel moves learning_rate gray levels (default 1)
+    towards the frame's pixel, so it converges on the median of the recent frames
+    without holding a window of them. Memory and cost per frame don't depend on
+    window_size, which only sets the warm up: for the first window_size frames the
+    background is the mean of the frames so far, after which the model is ready.
+
+    The background follows changes of at most learning_rate gray levels per frame, so
+    fast illumination changes can show up as foreground until it catches up. Only
+    uint8 frames are supported.
+    """
+
+    def __init__(self, window_size=11, threshold=10, reuse_buffers=False, learning_rate=None):
+        self.learning_rate = 1 if learning_rate is None else learning_rate
+        MedianBackground.__init__(self, window_size, threshold, reuse_buffers)
+
+    def update(self, frame, frame_number=None):
+        if frame.dtype != np.uint8:
+            raise ValueError('RunningMedianBackground requires uint8 frames')
+        if self.count < self.window_size:
+            self.update_warm_up(frame)
+        else:
+            cv2.compare(frame, self.background, cv2.CMP_GT, dst=self.step_mask)
+            cv2.add(self.background, self.learning_rate, dst=self.background, mask=self.step_mask)
+            cv2.compare(frame, self.background, cv2.CMP_LT, dst=self.step_mask)
+            cv2.subtract(self.background, self.learning_rate, dst=self.background, mask=self.step_mask)
+        self.update_foreground(frame)
+
+    def update_warm_up(self, frame):
+        """
+        Updates cumulative mean of the frames so far
+        """
+        if self.accumulator is None:
+            self.accumulator = np.zeros(frame.shape, dtype=np.float32)
+            self.background = np.zeros(frame.shape, dtype=np.uint8)
+            self.step_mask = np.zeros(frame.shape, dtype=np.uint8)
+        self.count += 1
+        cv2.accumulateWeighted(frame, self.accumulator, 1.0/self.count)
+        cv2.convertScaleAbs(self.accumulator, dst=self.background)
+        if self.count == self.window_size:
+            self.ready = True
+            self.accumulator = None
+
+    def get_state(self):
+        """
+        Returns state of model, e.g. for checkpointing: dictionary with the background
+        image ('frames', an array of one frame, or of none before the first update), the
+        ready flag and the number of warm up frames seen ('count').
+        """
+        if self.background is None:
+            frames = np.zeros((0,0,0), dtype=np.uint8)
+        elif self.accumulator is not None:
+            frames = np.array([self.accumulator])
+        else:
+            frames = np.array([self.background])
+        return {'frames': frames, 'ready': self.ready, 'count': self.count}
+
+    def set_state(self, state):
+        self.reset()
+        if len(state['frames']) == 0:
+            return
+        image = np.array(state['frames'][0])
+        self.count = int(state['count'])
+        self.ready = bool(state['ready'])
+        self.background = np.zeros(image.shape, dtype=np.uint8)
+        self.step_mask = np.zeros(image.shape, dtype=np.uint8)
+        if self.ready:
+            np.copyto(self.background, image, casting='unsafe')
+        else:
+            self.accumulator = image.astype(np.float32)
+            cv2.convertScaleAbs(self.accumulator, dst=self.background)
+
+    def reset(self):
+        MedianBackground.reset(self)
+        self.accumulator = None
+        self.step_mask = None
+
+
+class RunningAverageBackground(RunningMedianBackground):
+    """
+    Exponential running average background model: background = (1 - a)*background +
+    a*frame with a = learning_rate, which defaults to 2/(window_size + 1), the
+    weighting whose mean age matches a window of window_size frames. As for
+    RunningMedianBackground the first window_size frames are averaged equally and
+    memory and cost per frame don't depend on window_size. The average is kept in
+    float32 and rounded to give the uint8 background.
+
+    Once the model is ready foreground pixels are averaged in at foreground_rate
+    times the learning rate, so flies don't leave trails in the background while
+    lasting changes are still taken in.
+    """
+
+    foreground_rate = 0.05
+
+    def __init__(self, window_size=11, threshold=10, reuse_buffers=False, learning_rate=None):
+        if learning_rate is None:
+            learning_rate = 2.0/(window_size + 1)
+        RunningMedianBackground.__init__(self, window_size, threshold, reuse_buffers, learning_rate)
+
+    def update(self, frame, frame_number=None):
+        if self.accumulator is None:
+            self.accumulator = np.zeros(frame.shape, dtype=np.float32)
+            self.background = np.zeros(frame.shape, dtype=np.uint8)
+        if self.update_mask is None:
+            self.update_mask = np.zeros(frame.shape, dtype=np.uint8)
+        if self.count < self.window_size:
+            self.count += 1
+            alpha = max(1.0/self.count, self.learning_rate)
+            self.ready = self.count == self.window_size
+            cv2.accumulateWeighted(frame, self.accumulator, alpha)
+            cv2.convertScaleAbs(self.accumulator, dst=self.background)
+            self.update_foreground(frame)
+        else:
+            self.update_foreground(frame)
+            cv2.bitwise_not(self.foreground_mask, dst=self.update_mask)
+            cv2.accumulateWeighted(frame, self.accumulator, self.learning_rate, mask=self.update_mask)
+            cv2.accumulateWeighted(frame, self.accumulator, self.learning_rate*self.foreground_rate, mask=self.foreground_mask)
+            cv2.convertScaleAbs(self.accumulator, dst=self.background)
+
+    def get_state(self):
+        if self.accumulator is None:
+            frames = np.zeros((0,0,0), dtype=np.float32)
+        else:
+            frames = np.array([self.accumulator])
+        return {'frames': frames, 'ready': self.ready, 'count': self.count}
+
+    def set_state(self, state):
+        self.reset()
+        if len(state['frames']) == 0:
+            return
+        self.accumulator = np.array(state['frames'][0], dtype=np.float32)
+        self.background = np.zeros(self.accumulator.shape, dtype=np.uint8)
+        cv2.convertScaleAbs(self.accumulator, dst=self.background)
+        self.count = int(state['count'])
+        self.ready = bool(state['ready'])
+
+    def reset(self):
+        RunningMedianBackground.reset(self)
+        self.update_mask = None
+
+
+class SubtractorBackground(MedianBackground):
+    """
+    Background model using one of OpenCV's background subtractors, given by
+    create_subtractor in subclasses. The subtractor's own history is window_size
+    frames and the model is ready once it has seen that many. learning_rate is passed
+    to the subtractor's apply, None (-1) lets it choose from the history.
+
+    The subtractor's per pixel statistics can't be saved, so get_state only saves
+    the background image and set_state relearns the model from it, which gives an
+    approximation of the model's state.
+    """
+
+    def __init__(self, window_size=11, threshold=10, reuse_buffers=False, learning_rate=None):
+        self.learning_rate = -1 if learning_rate is None else learning_rate
+        MedianBackground.__init__(self, window_size, threshold, reuse_buffers)
+
+    def update(self, frame, frame_number=None):
+        if self.foreground_mask is None:
+            self.foreground_mask = np.zeros(frame.shape[:2], dtype=np.uint8)
+            self.foreground = np.zeros(frame.shape, dtype=frame.dtype)
+        self.foreground_mask = self.subtractor.apply(frame, self.foreground_mask, self.learning_rate)
+        self.background = self.subtractor.getBackgroundImage()
+        self.count = min(self.count + 1, self.window_size)
+        self.ready = self.count == self.window_size
+        if self.reuse_buffers:
+            # Pixels outside the mask keep their values in dst
+            self.foreground.fill(0)
+            cv2.bitwise_and(frame, frame, dst=self.foreground, mask=self.foreground_mask)
+        else:
+            self.foreground = cv2.bitwise_and(frame, frame, mask=self.foreground_mask)
+
+    def get_state(self):
+        if self.background is None:
+            frames = np.zeros((0,0,0), dtype=np.uint8)
+        else:
+            frames = np.array([self.background])
+        return {'frames': frames, 'ready': self.ready, 'count': self.count}
+
+    def set_state(self, state):
+        self.reset()
+        if len(state['frames']) == 0:
+            return
+        background = np.array(state['frames'][0], dtype=np.uint8)
+        for i in range(self.window_size):
+            self.subtractor.apply(background, None, 1.0 if i == 0 else -1)
+        self.background = background
+        self.count = int(state['count'])
+        self.ready = bool(state['ready'])
+
+    def reset(self):
+        MedianBackground.reset(self)
+        self.subtractor = self.create_subtractor()
+
+
+class MOG2Background(SubtractorBackground):
+    """
+    Gaussian mixture background model, OpenCV's BackgroundSubtractorMOG2, with
+    shadow detection off. A pixel is foreground if it is more than 4 standard
+    deviations from the mixture components, OpenCV's default, rather than more than
+    threshold gray levels from the background, so threshold isn't used.
+    """
+
+    def create_subtractor(self):
+        return cv2.createBackgroundSubtractorMOG2(
+                history=self.window_size,
+                detectShadows=False,
+                )
+
+
+class KNNBackground(SubtractorBackground):
+    """
+    K nearest neighbours background model, OpenCV's BackgroundSubtractorKNN, with
+    shadow detection off. A pixel is foreground if too few of its samples are within
+    threshold gray levels of it.
+    """
+
+    def create_subtractor(self):
+        return cv2.createBackgroundSubtractorKNN(
+                history=self.window_size,
+                dist2Threshold=float(self.threshold)**2,
+                detectShadows=False,
+                )
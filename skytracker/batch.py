@@ -0,0 +1,335 @@
+from __future__ import print_function
+import os
+import sys
+import cv2
+import json
+import time
+import argparse
+import traceback
+import multiprocessing
+
+from skytracker import SkyTracker
+
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.h264', '.mpg')
+
+# Parameters holding output file names, relative names are put in the video's output
+# directory.
+OUTPUT_FILE_PARAMS = ('output_video_name', 'blob_file_name', 'track_file_name', 'stats_file_name', 'checkpoint_file_name')
+
+STATUS_FILE_NAME = 'batch_status.json'
+SUMMARY_FILE_NAME = 'batch_summary.json'
+
+# Memory used by each worker process apart from frame buffers
+BASE_JOB_MEMORY = 200*2**20
+
+
+def load_video_list(source, default_param=None):
+    """
+    Returns list of videos to track as dictionaries with keys 'video' (file name),
+    'name' (used for the video's output directory) and 'param' (SkyTracker parameters,
+    default_param updated with the video's overrides).
+
+    source is either a directory, in which case all video files in it are tracked and
+    a json file with the same base name as a video (e.g. cam01.json for cam01.mp4)
+    gives overrides for that video, or a json manifest file of the form
+
+        {
+            "param": {...},
+            "videos": [
+                {"video": "cam01.mp4", "name": "cam01", "param": {...}},
+                "cam02.mp4",
+                ...
+            ]
+        }
+
+    where the top level "param" overrides default_param for all videos and "name" and
+    "param" are optional for each video. Relative video names are relative to the
+    manifest's directory.
+    """
+    base_param = dict(default_param or {})
+    entry_list = []
+    if os.path.isdir(source):
+        for file_name in sorted(os.listdir(source)):
+            base_name, ext = os.path.splitext(file_name)
+            if ext.lower() not in VIDEO_EXTENSIONS:
+                continue
+            entry = {'video': os.path.join(source, file_name), 'name': base_name, 'param': {}}
+            override_file = os.path.join(source, base_name + '.json')
+            if os.path.exists(override_file):
+                with open(override_file,'r') as f:
+                    entry['param'] = json.load(f)
+            entry_list.append(entry)
+    else:
+        with open(source,'r') as f:
+            manifest = json.load(f)
+        base_param.update(manifest.get('param', {}))
+        manifest_dir = os.path.dirname(os.path.abspath(source))
+        for item in manifest['videos']:
+            if not isinstance(item, dict):
+                item = {'video': item}
+            video = os.path.join(manifest_dir, item['video'])
+            name = item.get('name', os.path.splitext(os.path.basename(video))[0])
+            entry_list.append({'video': video, 'name': name, 'param': item.get('param', {})})
+
+    names = [entry['name'] for entry in entry_list]
+    if len(set(names)) != len(names):
+        raise ValueError('video names must be unique, give names in the manifest')
+
+    video_list = []
+    for entry in entry_list:
+        param = dict(base_param)
+        param.update(entry['param'])
+        video_list.append({'video': entry['video'], 'name': entry['name'], 'param': param})
+    return video_list
+
+
+def create_job(video_entry, output_dir):
+    """
+    Returns job for run_batch_job: the video entry with output file parameters in
+    the video's output directory, and run settings fixed for batch use (headless, one
+    worker per video, no progress output unless requested).
+    """
+    job_dir = os.path.join(output_dir, video_entry['name'])
+    param = dict(SkyTracker.default_param)
+    param['progress_interval'] = None
+    param.update(video_entry['param'])
+    param['headless'] = True
+    param['workers'] = 1
+    for key in OUTPUT_FILE_PARAMS:
+        if param.get(key) is not None and not os.path.isabs(param[key]):
+            param[key] = os.path.join(job_dir, param[key])
+    return {
+            'video': os.path.abspath(video_entry['video']),
+            'name': video_entry['name'],
+            'param': param,
+            'job_dir': job_dir,
+            }
+
+
+def get_output_files(job):
+    """
+    Returns list of output files the job writes
+    """
+    param = job['param']
+    output_files = []
+    for key in OUTPUT_FILE_PARAMS:
+        if param.get(key) is None:
+            continue
+        if key == 'track_file_name' and not param['online_tracking']:
+            continue
+        # The checkpoint is only needed to resume, not an output of the job
+        if key == 'checkpoint_file_name':
+            continue
+        output_files.append(param[key])
+    return output_files
+
+
+def get_video_signature(video):
+    stat = os.stat(video)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def is_up_to_date(job):
+    """
+    Returns previous status of job if its outputs are up to date, i.e. it finished
+    with the same parameters on the same (unmodified) video and its output files all
+    exist, otherwise None.
+    """
+    status_file = os.path.join(job['job_dir'], STATUS_FILE_NAME)
+    try:
+        with open(status_file,'r') as f:
+            status = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if status.get('status') != 'done':
+        return None
+    # Compare through json so tuples and lists compare equal
+    if json.loads(json.dumps(job['param'])) != status.get('param'):
+        return None
+    if status.get('video_signature') != get_video_signature(job['video']):
+        return None
+    if not all(os.path.exists(file_name) for file_name in get_output_files(job)):
+        return None
+    return status
+
+
+def run_batch_job(job):
+    """
+    Worker process entry point for run_batch. Tracks one video and returns its
+    status, which is also written to the video's output directory.
+    """
+    status = {
+            'video': job['video'],
+            'name': job['name'],
+            'param': job['param'],
+            'video_signature': get_video_signature(job['video']),
+            'frames': 0,
+            'time': 0.0,
+            'fps': 0.0,
+            }
+    if not os.path.isdir(job['job_dir']):
+        os.makedirs(job['job_dir'])
+    t0 = time.time()
+    try:
+        tracker = SkyTracker(input_video_name=job['video'], param=job['param'])
+        tracker.run()
+        status['status'] = 'done'
+        # No stats if the run was already finished in its checkpoint
+        if tracker.stats is not None:
+            status['frames'] = tracker.stats.frame_count
+    except Exception:
+        status['status'] = 'failed'
+        status['error'] = traceback.format_exc()
+    status['time'] = time.time() - t0
+    if status['time'] > 0:
+        status['fps'] = status['frames']/status['time']
+    with open(os.path.join(job['job_dir'], STATUS_FILE_NAME),'w') as f:
+        json.dump(status, f, indent=4)
+    return status
+
+
+def get_available_memory():
+    """
+    Returns available physical memory in bytes, or None if it can't be found
+    """
+    try:
+        with open('/proc/meminfo','r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])*1024
+    except (IOError, OSError):
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_AVPHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def estimate_job_memory(job):
+    """
+    Returns rough estimate of the peak memory in bytes used to track job's video: the
+    background window and working images, the decoded frames in flight, and a fixed
+    allowance for the interpreter and libraries.
+    """
+    param = job['param']
+    cap = cv2.VideoCapture(job['video'])
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+    frame_bytes = 3*width*height
+    gray_bytes = width*height//max(param['decimation'], 1)**2
+    frames_in_flight = 2
+    if param['execution_mode'] == 'pipeline':
+        frames_in_flight += 2*param['pipeline_queue_size']
+    # Window copies plus float64 median and working images. The approximate models
+    # don't keep the window, OpenCV's subtractors keep several floats per pixel.
+    if param['bg_model'] in ('median', 'incremental_median'):
+        window_bytes = gray_bytes*(2*param['bg_window_size'] + 16)
+    elif param['bg_model'] in ('mog2', 'knn'):
+        window_bytes = gray_bytes*64
+    else:
+        window_bytes = gray_bytes*16
+    return BASE_JOB_MEMORY + frames_in_flight*frame_bytes + window_bytes
+
+
+def get_number_of_workers(job_list, max_workers=None, memory_per_job=None):
+    """
+    Returns number of worker processes: the number of cores, or max_workers if given,
+    limited so that the largest job's memory estimate (or memory_per_job) times the
+    number of workers fits in the available memory, and to the number of jobs.
+    """
+    num_workers = max_workers or multiprocessing.cpu_count()
+    available_memory = get_available_memory()
+    if available_memory is not None and job_list:
+        if memory_per_job is None:
+            memory_per_job = max(estimate_job_memory(job) for job in job_list)
+        num_workers = min(num_workers, max(int(available_memory//memory_per_job), 1))
+    return max(min(num_workers, len(job_list)), 1)
+
+
+def run_batch(video_list, output_dir, max_workers=None, memory_per_job=None, force=False):
+    """
+    Tracks videos in video_list (see load_video_list) in a pool of worker processes,
+    one video per worker, writing each video's outputs to a subdirectory of output_dir
+    named after the video. Videos whose outputs are up to date are skipped unless
+    force is set. Returns list of statuses of all videos, which is also written to
+    batch_summary.json in output_dir.
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    status_list = []
+    job_list = []
+    for video_entry in video_list:
+        job = create_job(video_entry, output_dir)
+        status = None if force else is_up_to_date(job)
+        if status is not None:
+            status['status'] = 'up to date'
+            status_list.append(status)
+        else:
+            job_list.append(job)
+
+    print('{0} videos, {1} up to date'.format(len(video_list), len(status_list)))
+    t0 = time.time()
+    if job_list:
+        num_workers = get_number_of_workers(job_list, max_workers, memory_per_job)
+        print('tracking {0} videos with {1} workers'.format(len(job_list), num_workers))
+        # One video per process so memory is returned between videos
+        pool = multiprocessing.Pool(num_workers, maxtasksperchild=1)
+        try:
+            for status in pool.imap_unordered(run_batch_job, job_list):
+                print('{0}: {1}, {2} frames, {3:.1f} fps'.format(status['name'], status['status'], status['frames'], status['fps']))
+                status_list.append(status)
+        finally:
+            pool.close()
+            pool.join()
+
+    summary = {
+            'time': time.time() - t0,
+            'videos': sorted(status_list, key=lambda status: status['name']),
+            }
+    with open(os.path.join(output_dir, SUMMARY_FILE_NAME),'w') as f:
+        json.dump(summary, f, indent=4)
+    return summary['videos']
+
+
+def print_summary(status_list):
+    print()
+    print('{0:<24s} {1:<12s} {2:>8s} {3:>10s} {4:>8s}'.format('video', 'status', 'frames', 'time (s)', 'fps'))
+    for status in status_list:
+        print('{0:<24s} {1:<12s} {2:8d} {3:10.1f} {4:8.1f}'.format(
+            status['name'], status['status'], status['frames'], status['time'], status['fps']))
+    for status in status_list:
+        if status['status'] == 'failed':
+            print()
+            print('{0} failed:'.format(status['name']))
+            print(status['error'])
+
+
+def batch_main():
+
+    parser = argparse.ArgumentParser(description='Track a batch of videos, e.g. from many cameras, in parallel')
+    parser.add_argument('source', help='directory of videos or json manifest file')
+    parser.add_argument('-o','--output-dir', default='skytracker_output', help='directory for outputs, one subdirectory per video')
+    parser.add_argument('-c','--config', help='json configuration file with parameters for all videos')
+    parser.add_argument('-j','--jobs', type=int, help='maximum number of videos tracked at once (default: number of cores)')
+    parser.add_argument('--memory-per-job', type=float, help='memory in MB to allow per video instead of the estimate')
+    parser.add_argument('--force', action='store_true', help='track videos even if their outputs are up to date')
+
+    args = parser.parse_args()
+
+    default_param = {}
+    if args.config is not None:
+        with open(args.config,'r') as f:
+            default_param = json.load(f)
+
+    memory_per_job = None
+    if args.memory_per_job is not None:
+        memory_per_job = args.memory_per_job*2**20
+
+    video_list = load_video_list(args.source, default_param)
+    status_list = run_batch(video_list, args.output_dir, args.jobs, memory_per_job, args.force)
+    print_summary(status_list)
+    if any(status['status'] == 'failed' for status in status_list):
+        sys.exit(1)
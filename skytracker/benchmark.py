@@ -0,0 +1,363 @@
+from __future__ import print_function
+import os
+import sys
+import cv2
+import json
+import time
+import argparse
+import tempfile
+import numpy as np
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from skytracker import SkyTracker
+from blob_data_tools import load_blob_data
+from blob_data_tools import load_binary_blob_data
+from blob_data_tools import create_blob_writer
+from blob_data_tools import delete_blob_file
+from track_tools import BlobMatcher
+from track_tools import BlobStitcher
+from track_tools import filter_outlying_segments
+from track_tools import blob_positions
+from spatial_tools import match_points
+
+
+class SyntheticSky:
+    """
+    Synthetic upward facing camera footage with known fly trajectories.
+
+    The sky is a bright gradient with faint clouds which drift across the frame,
+    plus per-pixel noise. Each of number_of_flies flies is a dark disc of radius
+    fly_radius which is visible for part of the video and moves with constant velocity
+    plus a sinusoidal wobble, so flies enter and leave the frame and cross each other.
+    Everything is generated from seed so the same parameters always give the same
+    frames and trajectories.
+    """
+
+    def __init__(self, width=640, height=480, number_of_frames=300, number_of_flies=10, fly_radius=3.0,
+            noise=2.0, cloud_speed=0.25, seed=0):
+        self.width = width
+        self.height = height
+        self.number_of_frames = number_of_frames
+        self.number_of_flies = number_of_flies
+        self.fly_radius = fly_radius
+        self.noise = noise
+        self.cloud_speed = cloud_speed
+        self.seed = seed
+        self.rng = np.random.RandomState(seed)
+        self.create_sky()
+        self.create_trajectories()
+
+    def create_sky(self):
+        y, x = np.mgrid[0:self.height, 0:self.width]
+        self.gradient = 170.0 + 40.0*x/self.width + 20.0*y/self.height
+        # Clouds are smoothed noise on a canvas wide enough to drift across
+        cloud_width = self.width + int(np.ceil(self.cloud_speed*self.number_of_frames)) + 1
+        clouds = self.rng.normal(size=(self.height, cloud_width)).astype(np.float32)
+        clouds = cv2.GaussianBlur(clouds, (0,0), 25)
+        clouds *= 8.0/max(clouds.std(), 1e-6)
+        self.clouds = clouds
+
+    def create_trajectories(self):
+        n = self.number_of_flies
+        self.start_frame = self.rng.randint(0, max(self.number_of_frames//2, 1), n)
+        lifetime = self.rng.randint(max(self.number_of_frames//4, 2), self.number_of_frames + 1, n)
+        self.end_frame = np.minimum(self.start_frame + lifetime, self.number_of_frames)
+        self.start_pos = self.rng.uniform((0, 0), (self.width, self.height), (n, 2))
+        speed = self.rng.uniform(2.0, 6.0, n)
+        angle = self.rng.uniform(0, 2*np.pi, n)
+        self.velocity = np.column_stack((speed*np.cos(angle), speed*np.sin(angle)))
+        self.wobble_amplitude = self.rng.uniform(0.0, 10.0, (n, 2))
+        self.wobble_freq = self.rng.uniform(0.05, 0.2, (n, 1))
+        self.wobble_phase = self.rng.uniform(0, 2*np.pi, (n, 2))
+
+    def fly_positions(self, frame):
+        """
+        Returns ids and (n,2) array of positions of the flies visible in frame
+        """
+        fly_ids = np.flatnonzero((self.start_frame <= frame) & (frame < self.end_frame))
+        t = frame - self.start_frame[fly_ids, np.newaxis]
+        pos = (
+                self.start_pos[fly_ids] + self.velocity[fly_ids]*t +
+                self.wobble_amplitude[fly_ids]*np.sin(self.wobble_freq[fly_ids]*t + self.wobble_phase[fly_ids])
+                )
+        margin = self.fly_radius
+        inside = (
+                (pos[:,0] >= margin) & (pos[:,0] < self.width - margin) &
+                (pos[:,1] >= margin) & (pos[:,1] < self.height - margin)
+                )
+        return fly_ids[inside], pos[inside]
+
+    def frame(self, frame):
+        """
+        Returns gray scale image of frame
+        """
+        offset = int(self.cloud_speed*frame)
+        image = self.gradient + self.clouds[:, offset:offset+self.width]
+        # Noise depends only on seed and frame so frames can be generated in any order
+        rng = np.random.RandomState([self.seed, frame])
+        image += rng.normal(scale=self.noise, size=image.shape)
+        image = np.clip(image, 0, 255).astype(np.uint8)
+        # Sub-pixel positions with 4 fractional bits
+        shift = 4
+        for x, y in self.fly_positions(frame)[1]:
+            center = (int(round(x*2**shift)), int(round(y*2**shift)))
+            cv2.circle(image, center, int(round(self.fly_radius*2**shift)), 40, -1, cv2.LINE_AA, shift)
+        return image
+
+    def write_video(self, video_name, fps=20.0):
+        """
+        Writes frames to video file (MJPG codec, use an .avi file name)
+        """
+        vid = cv2.VideoWriter(video_name, cv2.VideoWriter_fourcc(*'MJPG'), fps, (self.width, self.height))
+        for n in range(self.number_of_frames):
+            vid.write(cv2.cvtColor(self.frame(n), cv2.COLOR_GRAY2BGR))
+        vid.release()
+
+
+def run_stage(stage_func, count):
+    """
+    Runs one benchmark stage, stage_func, twice: once to time it and once with
+    tracemalloc tracing to find the peak memory allocated by numpy and python while it
+    runs. Tracing slows python code several times over but not opencv, so timing a
+    traced run would distort the rates. Returns the value returned by the timed run
+    and dictionary with the stage's time, count, rate and peak memory.
+    """
+    start_time = time.time()
+    value = stage_func()
+    stage_time = time.time() - start_time
+    peak_memory = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            stage_func()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    stage = {
+            'time': stage_time,
+            'count': count,
+            'per_second': count/stage_time if stage_time > 0 else 0.0,
+            'peak_memory': peak_memory,
+            }
+    return value, stage
+
+
+def run_benchmark(sky, param=None, matcher_param=None, blob_file_dir=None):
+    """
+    Runs the tracking stages on the frames of sky (a SyntheticSky) and returns
+    dictionary of results: 'stages' with time, count, rate and peak memory of each
+    stage, 'accuracy' with detection and track accuracy against the known
+    trajectories, and 'max_rss' (process peak resident memory, where available).
+
+    param are SkyTracker parameters used to create the background model and blob
+    finder, matcher_param are BlobMatcher parameters.
+    """
+    tracker = SkyTracker(None, param)
+    if matcher_param is None:
+        matcher_param = {'max_blobs': None, 'max_dist': 10*sky.fly_radius}
+    match_radius = 2*sky.fly_radius
+    frames = [sky.frame(n) for n in range(sky.number_of_frames)]
+    stages = {}
+
+    def update_background():
+        bg_model = tracker.create_background_model()
+        mask_list = []
+        for image in frames:
+            bg_model.update(image)
+            mask_list.append(np.array(bg_model.foreground_mask) if bg_model.ready else None)
+        return mask_list
+    mask_list, stages['background'] = run_stage(update_background, len(frames))
+
+    blob_finder = tracker.create_blob_finder()
+    ready_frames = [n for n, mask in enumerate(mask_list) if mask is not None]
+    def find_blobs():
+        blob_data = []
+        for n in ready_frames:
+            blob_list, _, _ = blob_finder.find(frames[n], mask_list[n], draw=False)
+            blob_data.append({'frame': n, 'blobs': blob_list})
+        return blob_data
+    blob_data, stages['blob_find'] = run_stage(find_blobs, len(ready_frames))
+
+    # Blob file save and load in both formats
+    if blob_file_dir is None:
+        blob_file_dir = tempfile.mkdtemp(prefix='skytracker_benchmark_')
+    for file_format, load_func in (('json', load_blob_data), ('binary', load_binary_blob_data)):
+        blob_file_name = os.path.join(blob_file_dir, 'blob_data.{0}'.format(file_format))
+        def save():
+            blob_writer = create_blob_writer(blob_file_name, file_format)
+            for item in blob_data:
+                blob_writer.write(item['frame'], item['blobs'])
+            blob_writer.close()
+        _, stages['save_{0}'.format(file_format)] = run_stage(save, len(blob_data))
+        def load():
+            loaded_data = load_func(blob_file_name)
+            if file_format == 'binary':
+                loaded_data = list(loaded_data)
+            return loaded_data
+        _, stages['load_{0}'.format(file_format)] = run_stage(load, len(blob_data))
+        delete_blob_file(blob_file_name)
+
+    matcher = BlobMatcher(matcher_param)
+    match_list, stages['match'] = run_stage(lambda: matcher.get_match_list(blob_data), len(blob_data))
+
+    stitcher = BlobStitcher()
+    track_list, stages['stitch'] = run_stage(lambda: stitcher.get_track_list(match_list), len(match_list))
+
+    _, stages['filter'] = run_stage(lambda: filter_outlying_segments(track_list), len(track_list))
+
+    accuracy = get_accuracy(sky, blob_data, track_list, match_radius)
+
+    max_rss = None
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'stages': stages, 'accuracy': accuracy, 'max_rss': max_rss}
+
+
+def get_accuracy(sky, blob_data, track_list, match_radius):
+    """
+    Returns dictionary of detection and track accuracy. Blobs are matched to the true
+    fly positions in each frame, with matched blobs no more than match_radius away.
+
+    recall is the fraction of true fly positions with a matched blob, precision the
+    fraction of blobs matched and position_rmse the rms distance of matched blobs.
+    track_purity is the fraction of track points belonging to the fly to which most
+    of the track's points belong, tracks_per_fly is the mean number of tracks for
+    each fly with any (1.0 if tracks are never broken) and number_of_tracks the
+    number of tracks.
+    """
+    true_ids = {}
+    num_true = 0
+    num_blobs = 0
+    dist_list = []
+    for item in blob_data:
+        fly_ids, true_pos = sky.fly_positions(item['frame'])
+        num_true += len(fly_ids)
+        num_blobs += len(item['blobs'])
+        pos = blob_positions(item['blobs'])
+        index0, index1 = match_points(true_pos, pos, match_radius)
+        for i, j in zip(index0.tolist(), index1.tolist()):
+            blob = item['blobs'][j]
+            true_ids[(item['frame'], blob['centroid_x'], blob['centroid_y'])] = int(fly_ids[i])
+            dist_list.append(np.hypot(*(true_pos[i] - pos[j])))
+
+    num_points = 0
+    num_pure = 0
+    tracks_per_fly = {}
+    for track in track_list:
+        ids = []
+        for point in track:
+            key = (point['frame'], point['blob']['centroid_x'], point['blob']['centroid_y'])
+            if key in true_ids:
+                ids.append(true_ids[key])
+        if not ids:
+            continue
+        values, counts = np.unique(ids, return_counts=True)
+        num_points += len(ids)
+        num_pure += counts.max()
+        majority_id = int(values[counts.argmax()])
+        tracks_per_fly[majority_id] = tracks_per_fly.get(majority_id, 0) + 1
+
+    return {
+            'recall': len(dist_list)/float(num_true) if num_true else 1.0,
+            'precision': len(dist_list)/float(num_blobs) if num_blobs else 1.0,
+            'position_rmse': float(np.sqrt(np.mean(np.square(dist_list)))) if dist_list else 0.0,
+            'track_purity': num_pure/float(num_points) if num_points else 1.0,
+            'tracks_per_fly': float(np.mean(list(tracks_per_fly.values()))) if tracks_per_fly else 0.0,
+            'number_of_tracks': len(track_list),
+            }
+
+
+def compare_results(results, baseline, speed_tolerance=0.2, accuracy_tolerance=0.01):
+    """
+    Compares results with baseline results. Returns list of (stage or measure name,
+    description) of regressions: stages slower by more than speed_tolerance
+    (fraction) and accuracy measures worse by more than accuracy_tolerance.
+    """
+    regressions = []
+    for name, stage in results['stages'].items():
+        base_stage = baseline['stages'].get(name)
+        if base_stage is None or base_stage['per_second'] <= 0:
+            continue
+        ratio = stage['per_second']/base_stage['per_second']
+        if ratio < 1.0 - speed_tolerance:
+            regressions.append((name, 'rate {0:.1f}/s vs {1:.1f}/s baseline'.format(stage['per_second'], base_stage['per_second'])))
+    for name in ('recall', 'precision', 'track_purity'):
+        value = results['accuracy'][name]
+        base_value = baseline['accuracy'].get(name)
+        if base_value is not None and value < base_value - accuracy_tolerance:
+            regressions.append((name, '{0:.4f} vs {1:.4f} baseline'.format(value, base_value)))
+    return regressions
+
+
+def print_results(results):
+    print('stage          count    time (s)       rate/s   peak mem (MB)')
+    for name, stage in sorted(results['stages'].items()):
+        peak_memory = stage['peak_memory']
+        peak_memory = '{0:14.2f}'.format(peak_memory/2.0**20) if peak_memory is not None else '           n/a'
+        print('{0:<12s} {1:7d} {2:11.3f} {3:12.1f} {4}'.format(name, stage['count'], stage['time'], stage['per_second'], peak_memory))
+    print()
+    for name, value in sorted(results['accuracy'].items()):
+        print('{0:<18s} {1:.4f}'.format(name, value))
+    if results['max_rss'] is not None:
+        print('{0:<18s} {1}'.format('max_rss', results['max_rss']))
+
+
+def benchmark_main():
+
+    parser = argparse.ArgumentParser(description='Benchmark tracking stages on synthetic sky videos with known fly trajectories')
+    parser.add_argument('--width', type=int, default=640, help='frame width')
+    parser.add_argument('--height', type=int, default=480, help='frame height')
+    parser.add_argument('--frames', type=int, default=300, help='number of frames')
+    parser.add_argument('--flies', type=int, default=10, help='number of fly trajectories')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the synthetic video')
+    parser.add_argument('-c','--config', help='json file of SkyTracker parameters, e.g. bg_model')
+    parser.add_argument('--video', help='also write the synthetic video to this file (.avi)')
+    parser.add_argument('-o','--output', help='write results to this json file')
+    parser.add_argument('--baseline', help='json results file to compare against, exit status is 1 on regressions')
+
+    args = parser.parse_args()
+
+    param = {'min_area': 1}
+    if args.config is not None:
+        with open(args.config,'r') as f:
+            param.update(json.load(f))
+
+    sky = SyntheticSky(
+            width=args.width,
+            height=args.height,
+            number_of_frames=args.frames,
+            number_of_flies=args.flies,
+            seed=args.seed,
+            )
+    if args.video is not None:
+        sky.write_video(args.video)
+
+    results = run_benchmark(sky, param)
+    results['settings'] = vars(args)
+    results['param'] = param
+    print_results(results)
+
+    if args.output is not None:
+        with open(args.output,'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline,'r') as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline)
+        print()
+        if not regressions:
+            print('no regressions against {0}'.format(args.baseline))
+        for name, description in regressions:
+            print('regression: {0}: {1}'.format(name, description))
+        if regressions:
+            sys.exit(1)
@@ -1,11 +1,41 @@
+import os
 import re
 import sys
 import json
 import json.tool
+import shutil
+import numpy as np
 
 FLAGS = re.VERBOSE | re.MULTILINE | re.DOTALL
 WHITESPACE = re.compile(r'[ \t\n\r]*', FLAGS)
 
+# Binary blob data format. The data file holds one fixed size record per blob, in
+# frame order, after an 8 byte magic header. The index file, with the same name plus
+# '.index', holds one record per frame giving the offset and number of its blobs in the
+# data file.
+BLOB_DATA_MAGIC = b'SKYBLOB1'
+BLOB_INDEX_MAGIC = b'SKYBIDX1'
+BLOB_INDEX_EXT = '.index'
+
+BLOB_DTYPE = np.dtype([
+    ('frame', '<i8'),
+    ('centroid_x', '<f8'),
+    ('centroid_y', '<f8'),
+    ('min_x', '<f8'),
+    ('max_x', '<f8'),
+    ('min_y', '<f8'),
+    ('max_y', '<f8'),
+    ('area', '<f8'),
+    ])
+
+FRAME_INDEX_DTYPE = np.dtype([
+    ('frame', '<i8'),
+    ('offset', '<i8'),
+    ('count', '<i8'),
+    ])
+
+BLOB_KEYS = ('centroid_x', 'centroid_y', 'min_x', 'max_x', 'min_y', 'max_y', 'area')
+
 class ConcatJSONDecoder(json.JSONDecoder):
     def decode(self, s, _w=WHITESPACE.match):
         s_len = len(s)
@@ -27,5 +57,339 @@ def load_blob_data(filename):
     return dataList
 
 
+def iter_blob_data(filename, start_frame=None, end_frame=None):
+    """
+    Generator which reads blob data file one frame at a time, yielding the same
+    {'frame': frame, 'blobs': blob_list} items as load_blob_data but using constant
+    memory. Works for both json and binary blob data files. If start_frame and/or
+    end_frame are given only frames in [start_frame, end_frame) are returned,
+    reading stops as soon as end_frame is reached.
+    """
+    if is_binary_blob_file(filename):
+        blob_data = BinaryBlobData(filename)
+        frames = blob_data.index['frame']
+        n0 = 0 if start_frame is None else np.searchsorted(frames, start_frame)
+        n1 = len(blob_data) if end_frame is None else np.searchsorted(frames, end_frame)
+        for n in range(n0, n1):
+            yield blob_data[n]
+        return
+
+    decoder = json.JSONDecoder()
+    buf = ''
+    with open(filename,'r') as f:
+        for line in f:
+            buf += line
+            while True:
+                pos = WHITESPACE.match(buf).end()
+                if pos == len(buf):
+                    buf = ''
+                    break
+                try:
+                    item, pos = decoder.raw_decode(buf, idx=pos)
+                except ValueError:
+                    # Object continues on following lines
+                    buf = buf[pos:]
+                    break
+                buf = buf[pos:]
+                if end_frame is not None and item['frame'] >= end_frame:
+                    return
+                if start_frame is None or item['frame'] >= start_frame:
+                    yield item
+    if buf.strip():
+        raise ValueError('incomplete blob data at end of {0}'.format(filename))
+
+
+def is_binary_blob_file(filename):
+    with open(filename,'rb') as f:
+        return f.read(len(BLOB_DATA_MAGIC)) == BLOB_DATA_MAGIC
+
+
+def merge_blob_files(part_file_list, filename, file_format='json'):
+    """
+    Concatenates blob data files, e.g. from SkyTracker.run_parallel, into a single
+    blob data file. The part files should be given in frame order.
+    """
+    if file_format == 'binary':
+        merge_binary_blob_files(part_file_list, filename)
+        return
+    with open(filename,'w') as fout:
+        for part_file in part_file_list:
+            with open(part_file,'r') as fin:
+                for line in fin:
+                    fout.write(line)
+
+
+def delete_blob_file(filename):
+    """
+    Deletes blob data file along with its index file if it has one.
+    """
+    os.remove(filename)
+    if os.path.exists(filename + BLOB_INDEX_EXT):
+        os.remove(filename + BLOB_INDEX_EXT)
+
+
+def create_blob_writer(filename, file_format='json', state=None):
+    """
+    Returns writer for blob data file, file_format is either 'json' or 'binary'. If
+    state (from the writer's get_state) is given the existing file is truncated to
+    that state and appended to.
+    """
+    if file_format == 'json':
+        return JsonBlobWriter(filename, state)
+    elif file_format == 'binary':
+        return BinaryBlobWriter(filename, state)
+    else:
+        raise ValueError('unknown blob file format {0}'.format(file_format))
+
+
+def open_for_append(filename, offset, mode='r+'):
+    """
+    Opens existing file for writing, truncated to offset bytes and positioned at the
+    end, e.g. to resume writing from a checkpoint.
+    """
+    fid = open(filename, mode)
+    fid.seek(offset)
+    fid.truncate()
+    return fid
+
+
+class JsonBlobWriter:
+    """
+    Writes blob data as one json object per line, {'frame': frame, 'blobs': blob_list}
+    """
+
+    def __init__(self, filename, state=None):
+        self.filename = filename
+        if state is None:
+            self.fid = open(filename, 'w')
+        else:
+            self.fid = open_for_append(filename, state['offset'])
+
+    def get_state(self):
+        """
+        Returns state from which writing can be resumed, see create_blob_writer. The
+        file is flushed so that the data up to this point is on disk.
+        """
+        self.fid.flush()
+        return {'offset': self.fid.tell()}
+
+    def write(self, frame, blob_list):
+        frame_data = {'frame': frame, 'blobs' : blob_list}
+        frame_data_json = json.dumps(frame_data)
+        self.fid.write('{0}\n'.format(frame_data_json))
+
+    def close(self):
+        self.fid.close()
+
+
+class BinaryBlobWriter:
+    """
+    Writes blob data in the binary format read by load_binary_blob_data. Records are
+    appended as they are written and each frame's blobs are flushed to the data file
+    before its index record is written, so the file can be read back up to the last
+    complete frame even if the writer is not closed.
+    """
+
+    def __init__(self, filename, state=None):
+        self.filename = filename
+        if state is None:
+            self.data_fid = open(filename, 'wb')
+            self.data_fid.write(BLOB_DATA_MAGIC)
+            self.index_fid = open(filename + BLOB_INDEX_EXT, 'wb')
+            self.index_fid.write(BLOB_INDEX_MAGIC)
+            self.data_fid.flush()
+            self.index_fid.flush()
+            self.num_blobs = 0
+        else:
+            self.data_fid = open_for_append(filename, state['data_offset'], 'r+b')
+            self.index_fid = open_for_append(filename + BLOB_INDEX_EXT, state['index_offset'], 'r+b')
+            self.num_blobs = state['num_blobs']
+
+    def get_state(self):
+        """
+        Returns state from which writing can be resumed, see create_blob_writer
+        """
+        self.data_fid.flush()
+        self.index_fid.flush()
+        return {
+                'data_offset': self.data_fid.tell(),
+                'index_offset': self.index_fid.tell(),
+                'num_blobs': self.num_blobs,
+                }
+
+    def write(self, frame, blob_list):
+        self.write_records(frame, blob_list_to_records(blob_list, frame))
+
+    def write_records(self, frame, blobs):
+        """
+        Writes blobs for frame given as array with dtype BLOB_DTYPE
+        """
+        index = np.array([(frame, self.num_blobs, blobs.shape[0])], dtype=FRAME_INDEX_DTYPE)
+        self.data_fid.write(blobs.tobytes())
+        # Index records never point past the blobs on disk
+        self.data_fid.flush()
+        self.index_fid.write(index.tobytes())
+        self.index_fid.flush()
+        self.num_blobs += blobs.shape[0]
+
+    def close(self):
+        self.data_fid.close()
+        self.index_fid.close()
+
+
+class BinaryBlobData:
+    """
+    Memory-mapped view of a binary blob data file. The blob columns, e.g. blobs['frame'],
+    blobs['centroid_x'], and the per-frame index, with columns 'frame', 'offset' and
+    'count', are numpy arrays backed by the file, so opening even very large files is
+    immediate and nothing is read until it is used.
+
+    Iterating over it gives the same {'frame': frame, 'blobs': blob_list} items as
+    load_blob_data.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.blobs = memmap_records(filename, BLOB_DTYPE, BLOB_DATA_MAGIC)
+        self.index = memmap_records(filename + BLOB_INDEX_EXT, FRAME_INDEX_DTYPE, BLOB_INDEX_MAGIC)
+        # Drop frames whose blobs weren't written, e.g. if the writer was killed
+        complete = self.index['offset'] + self.index['count'] <= self.blobs.shape[0]
+        if not complete.all():
+            self.index = self.index[complete]
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def __getitem__(self, i):
+        return self.get_item(self.index[i])
+
+    def __iter__(self):
+        for index_record in self.index:
+            yield self.get_item(index_record)
+
+    def frames(self):
+        return self.index['frame']
+
+    def get_frame_blobs(self, frame):
+        """
+        Returns records for blobs in given frame (a view into the file) assuming
+        frames are in increasing order.
+        """
+        i = np.searchsorted(self.index['frame'], frame)
+        if i >= len(self) or self.index['frame'][i] != frame:
+            return self.blobs[0:0]
+        return self.get_records(self.index[i])
+
+    def get_records(self, index_record):
+        offset = int(index_record['offset'])
+        return self.blobs[offset:offset+int(index_record['count'])]
+
+    def get_item(self, index_record):
+        records = self.get_records(index_record)
+        return {'frame': int(index_record['frame']), 'blobs': blob_records_to_list(records)}
+
+
+def blob_records_to_list(records):
+    """
+    Converts array of blob records with dtype BLOB_DTYPE to list of blob dictionaries
+    """
+    columns = [records[key].tolist() for key in BLOB_KEYS]
+    return [dict(zip(BLOB_KEYS, values)) for values in zip(*columns)]
+
+
+def blob_list_to_records(blob_list, frame=0):
+    """
+    Converts list of blob dictionaries to array of blob records with dtype BLOB_DTYPE
+    """
+    records = np.zeros((len(blob_list),), dtype=BLOB_DTYPE)
+    records['frame'] = frame
+    for key in BLOB_KEYS:
+        records[key] = [blob[key] for blob in blob_list]
+    return records
+
+
+def load_binary_blob_data(filename):
+    """
+    Opens binary blob data file written with 'blob_file_format': 'binary'. Returns
+    BinaryBlobData memory mapping the file.
+    """
+    return BinaryBlobData(filename)
+
+
+def memmap_records(filename, dtype, magic):
+    with open(filename, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise IOError('{0} is not a binary blob data file'.format(filename))
+    size = os.path.getsize(filename) - len(magic)
+    # Ignore partial record at end of file, e.g. if the writer was killed
+    num_records = size//dtype.itemsize
+    if num_records == 0:
+        return np.zeros((0,), dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', offset=len(magic), shape=(num_records,))
+
+
+def merge_binary_blob_files(part_file_list, filename):
+    data_fid = open(filename, 'wb')
+    index_fid = open(filename + BLOB_INDEX_EXT, 'wb')
+    try:
+        data_fid.write(BLOB_DATA_MAGIC)
+        index_fid.write(BLOB_INDEX_MAGIC)
+        num_blobs = 0
+        for part_file in part_file_list:
+            part_data = BinaryBlobData(part_file)
+            with open(part_file, 'rb') as fin:
+                fin.seek(len(BLOB_DATA_MAGIC))
+                shutil.copyfileobj(fin, data_fid)
+            index = np.array(part_data.index)
+            index['offset'] += num_blobs
+            index_fid.write(index.tobytes())
+            num_blobs += part_data.blobs.shape[0]
+            del part_data
+    finally:
+        data_fid.close()
+        index_fid.close()
+
+
+class TrackWriter:
+    """
+    Writes tracks as one json object per line, {'track': track}, where track is a
+    list of {'frame': frame, 'blob': blob} items. The file is flushed after each track
+    so tracks can be read while it is still being written. Compact tracks (see
+    track.Track) are written in the same form.
+    """
+
+    def __init__(self, filename, state=None):
+        self.filename = filename
+        if state is None:
+            self.fid = open(filename, 'w')
+        else:
+            self.fid = open_for_append(filename, state['offset'])
+
+    def get_state(self):
+        return {'offset': self.fid.tell()}
+
+    def write(self, track):
+        if hasattr(track, 'to_list'):
+            track = track.to_list()
+        self.fid.write('{0}\n'.format(json.dumps({'track': track})))
+        self.fid.flush()
+
+    def close(self):
+        self.fid.close()
+
+
+def iter_track_data(filename):
+    """
+    Generator which reads tracks, as written by TrackWriter, one at a time.
+    """
+    with open(filename,'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)['track']
 
 
+def load_track_data(filename):
+    """
+    Returns list of all tracks in track data file written by TrackWriter.
+    """
+    return list(iter_track_data(filename))
@@ -2,9 +2,28 @@ from __future__ import print_function
 import cv2
 import numpy as np
 
+from blob_data_tools import BLOB_DTYPE
+from blob_data_tools import blob_records_to_list
+from blob_data_tools import blob_list_to_records
+from spatial_tools import variable_radius_self_pairs
+from spatial_tools import cluster_labels
+
 class BlobFinder:
+    """
+    Finds blobs in foreground masks. blob_method selects how blobs are extracted:
+    'contour' finds external contours and measures them one at a time, 'components'
+    uses cv2.connectedComponentsWithStats to measure all blobs in one call (see
+    find_blob_array), which is much faster for frames with many small blobs. With
+    'components' blob areas are pixel counts rather than contour areas.
+
+    Blobs closer together than min_interblob_spacing times their largest dimension
+    are fused. fuse_method selects how: 'pairwise' compares each blob with the blobs
+    already found and averages the centroids of each pair fused, so the result depends
+    on the order in which blobs are found, 'cluster' fuses clusters of nearby blobs
+    transitively using a grid neighbour search (see fuse_blob_array).
+    """
 
-    def __init__(self, filter_by_area=True, min_area=100, max_area=None, open_kernel_size=3, close_kernel_size=3,kernel_shape='ellipse',min_interblob_spacing = 2):
+    def __init__(self, filter_by_area=True, min_area=100, max_area=None, open_kernel_size=3, close_kernel_size=3,kernel_shape='ellipse',min_interblob_spacing = 2,blob_method='contour',fuse_method='pairwise',reuse_buffers=False):
         self.filter_by_area = filter_by_area 
         self.min_area = min_area 
         self.max_area = max_area 
@@ -16,29 +35,48 @@ class BlobFinder:
         # -------------KJL 2017_12_14 -----------------------
         self.min_interblob_spacing = min_interblob_spacing #expressed as a fraction of the blob's longest dimension; helps prevent a fly from being seen as two separate blobs
         # -------------KJL 2017_12_14 -----------------------
-    def find(self, image, fg_mask):
+        if blob_method not in ('contour', 'components'):
+            raise ValueError('unknown blob_method {0}'.format(blob_method))
+        self.blob_method = blob_method
+        if fuse_method not in ('pairwise', 'cluster'):
+            raise ValueError('unknown fuse_method {0}'.format(fuse_method))
+        self.fuse_method = fuse_method
+        # Output of apply_morphology is written to the same buffer every frame
+        self.reuse_buffers = reuse_buffers
+        self.morphology_buffer = None
+        self.open_kernel, self.close_kernel = self.create_kernels()
 
-        dummy, contour_list, dummy = cv2.findContours(fg_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    def create_kernels(self):
+        """
+        Returns opening and closing kernels, or None, None if no morphology is applied
+        """
+        if self.open_kernel_size[0]*self.open_kernel_size[1] <= 0:
+            return None, None
 
-        fg_mask_copy = np.array(fg_mask)
+        if self.kernel_shape == 'rect':
+            open_kernel = np.ones(self.open_kernel_size, np.uint8)
+            close_kernel = np.ones(self.close_kernel_size, np.uint8)
+        else:
+            open_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE,self.open_kernel_size)
+            close_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE,self.close_kernel_size)
+            open_kernel = np.logical_or(open_kernel,open_kernel.T).astype(np.uint8)
+            close_kernel = np.logical_or(close_kernel,close_kernel.T).astype(np.uint8)
+        return open_kernel, close_kernel
 
-        if self.open_kernel_size[0]*self.open_kernel_size[1] > 0: 
+    def find(self, image, fg_mask, draw=True):
+        """
+        Finds blobs in foreground mask. Returns list of blobs along with blob and
+        tracking circle overlay images. When draw is False the overlay images are not
+        rendered and None is returned in their place.
+        """
+        if self.blob_method == 'components':
+            return self.find_with_components(image, fg_mask, draw)
 
-            
-            if self.kernel_shape == 'rect':
-                open_kernel = np.ones(self.open_kernel_size, np.uint8)
-                close_kernel = np.ones(self.close_kernel_size, np.uint8)
-            else:
-                open_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE,self.open_kernel_size) 
-                close_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE,self.close_kernel_size)
-                open_kernel = np.logical_or(open_kernel,open_kernel.T).astype(np.uint8)
-                close_kernel = np.logical_or(close_kernel,close_kernel.T).astype(np.uint8)
+        dummy, contour_list, dummy = cv2.findContours(fg_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+
+        # Copy of mask with morphology applied is only used for drawing
+        fg_mask_copy = self.apply_morphology(fg_mask) if draw else None
 
-            #------ Will is using this opening to remove higher-intensity noise
-            fg_mask_copy = cv2.morphologyEx(fg_mask_copy,cv2.MORPH_OPEN,open_kernel)
-            #---- KJL 2017_12_04 noticed some flies are split into two; maybe a "closing" operation will be helpful here            
-            fg_mask_copy = cv2.morphologyEx(fg_mask_copy,cv2.MORPH_CLOSE,close_kernel)
-            #-----------------------------------------------------------------------------------------------------------
         # Find blob data
         blob_list = []
         blob_contours = []
@@ -76,39 +114,6 @@ class BlobFinder:
                 min_y = bound_rect[1]
                 max_x = bound_rect[0] + bound_rect[2] 
                 max_y = bound_rect[1] + bound_rect[3] 
-
-                #----------------KJL 2017_12_14 ---------------------------
-
-                dx = bound_rect[2]
-                dy = bound_rect[3]
-                max_dim = max(dx,dy)
-                fuse_blobs_across = max_dim*self.min_interblob_spacing
-                for other_index, other_blob in enumerate(blob_list):
-                    
-                    other_x, other_y = other_blob['centroid_x'], other_blob['centroid_y'] 
-
-                    if np.sqrt((centroid_x-other_x)**2 + (centroid_y-other_y)**2) < fuse_blobs_across:
-
-                        print ('fusing two blobs')
-                        blob_ok = False
-                        new_centroid_x = (centroid_x + other_x)/2 #could be cheesy-- I'm just averaging the centroids
-                        new_centroid_y = (centroid_y + other_y)/2
-                        new_area = area + other_blob['area']
-                        new_min_x = min(min_x, other_blob['min_x'])
-                        new_min_y = min(min_y, other_blob['min_y'])
-                        new_max_x = max(max_x, other_blob['max_x'])
-                        new_max_y = max(max_y, other_blob['max_y'])
-                        fused_blob = {
-                                'centroid_x' : new_centroid_x, 
-                                'centroid_y' : new_centroid_y, 
-                                'min_x'      : new_min_x, 
-                                'max_x'      : new_max_x, 
-                                'min_y'      : new_min_y, 
-                                'max_y'      : new_max_y, 
-                                'area'       : new_area,}
-                        blob_list[other_index] = fused_blob 
-
-            #----------------KJL 2017_12_14 -----------------------------
             else:
                 min_x = 0.0 
                 min_y = 0.0
@@ -124,18 +129,200 @@ class BlobFinder:
                     'max_y'      : max_y,
                     'area'       : area,
                     } 
+
+            # Fuse with nearby blobs already found
+            if blob_ok and self.fuse_method == 'pairwise' and self.fuse_blob(blob, blob_list):
+                blob_ok = False
             
             # If blob is OK add to list of blobs
             if blob_ok: 
                 blob_list.append(blob)
                 blob_contours.append(contour)
 
+        if self.fuse_method == 'cluster':
+            blob_list = blob_records_to_list(self.fuse_blob_array(blob_list_to_records(blob_list)))
+
+        if not draw:
+            return blob_list, None, None
 
         # Draw blob on image
         blob_image = cv2.cvtColor(fg_mask_copy,cv2.COLOR_GRAY2BGR)
         cv2.drawContours(blob_image,blob_contours,-1,(0,0,255),3)
 
-        # Draw tracking circles on image
+        circ_image = self.draw_circles(image, blob_list)
+
+        return blob_list, blob_image, circ_image
+
+    def find_with_components(self, image, fg_mask, draw=True):
+        """
+        Version of find using find_blob_array. The blob array is only converted to a
+        list of blob dictionaries for output.
+        """
+        blob_array, label_image, blob_labels = self.find_blob_array(fg_mask)
+
+        if self.fuse_method == 'cluster':
+            blob_list = blob_records_to_list(self.fuse_blob_array(blob_array))
+        else:
+            blob_list = []
+            for blob in blob_records_to_list(blob_array):
+                if not self.fuse_blob(blob, blob_list):
+                    blob_list.append(blob)
+
+        if not draw:
+            return blob_list, None, None
+
+        # Draw blob pixels on image
+        blob_image = cv2.cvtColor(self.apply_morphology(fg_mask),cv2.COLOR_GRAY2BGR)
+        blob_image[np.isin(label_image, blob_labels)] = (0,0,255)
+
+        circ_image = self.draw_circles(image, blob_list)
+
+        return blob_list, blob_image, circ_image
+
+    def find_blob_array(self, fg_mask):
+        """
+        Finds blobs in foreground mask with cv2.connectedComponentsWithStats (8-connected)
+        and applies the area filter to all of them at once. Returns array of blobs with
+        dtype BLOB_DTYPE (with frame set to 0), the label image and the array of labels
+        of the returned blobs in the label image. No fusion of nearby blobs is done.
+        """
+        num_labels, label_image, stats, centroids = cv2.connectedComponentsWithStats(fg_mask, connectivity=8)
+
+        # Label 0 is the background
+        area = stats[1:,cv2.CC_STAT_AREA].astype(np.float64)
+        blob_ok = np.ones(area.shape, dtype=bool)
+        if self.filter_by_area:
+            blob_ok &= area > 0
+            if self.min_area is not None:
+                blob_ok &= area >= self.min_area
+            if self.max_area is not None:
+                blob_ok &= area <= self.max_area
+        blob_labels = np.flatnonzero(blob_ok) + 1
+
+        blob_stats = stats[blob_labels]
+        blob_array = np.zeros(blob_labels.shape, dtype=BLOB_DTYPE)
+        blob_array['centroid_x'] = centroids[blob_labels,0]
+        blob_array['centroid_y'] = centroids[blob_labels,1]
+        blob_array['min_x'] = blob_stats[:,cv2.CC_STAT_LEFT]
+        blob_array['max_x'] = blob_stats[:,cv2.CC_STAT_LEFT] + blob_stats[:,cv2.CC_STAT_WIDTH]
+        blob_array['min_y'] = blob_stats[:,cv2.CC_STAT_TOP]
+        blob_array['max_y'] = blob_stats[:,cv2.CC_STAT_TOP] + blob_stats[:,cv2.CC_STAT_HEIGHT]
+        blob_array['area'] = area[blob_labels-1]
+        return blob_array, label_image, blob_labels
+
+    def apply_morphology(self, fg_mask):
+        """
+        Returns copy of foreground mask with opening and closing applied. With
+        reuse_buffers the copy is overwritten by the next call.
+        """
+        if self.reuse_buffers:
+            if self.morphology_buffer is None or self.morphology_buffer.shape != fg_mask.shape:
+                self.morphology_buffer = np.zeros_like(fg_mask)
+            fg_mask_copy = self.morphology_buffer
+        else:
+            fg_mask_copy = np.zeros_like(fg_mask)
+
+        if self.open_kernel is None:
+            np.copyto(fg_mask_copy, fg_mask)
+        else:
+            #------ Will is using this opening to remove higher-intensity noise
+            cv2.morphologyEx(fg_mask,cv2.MORPH_OPEN,self.open_kernel,dst=fg_mask_copy)
+            #---- KJL 2017_12_04 noticed some flies are split into two; maybe a "closing" operation will be helpful here
+            cv2.morphologyEx(fg_mask_copy,cv2.MORPH_CLOSE,self.close_kernel,dst=fg_mask_copy)
+            #-----------------------------------------------------------------------------------------------------------
+        return fg_mask_copy
+
+    def fuse_blob(self, blob, blob_list):
+        """
+        Fuses blob into any blobs in blob_list whose centroids are closer than
+        min_interblob_spacing times its largest dimension. Returns True if blob was
+        fused, in which case it shouldn't be added to blob_list.
+        """
+        centroid_x = blob['centroid_x']
+        centroid_y = blob['centroid_y']
+        min_x = blob['min_x']
+        min_y = blob['min_y']
+        max_x = blob['max_x']
+        max_y = blob['max_y']
+        area = blob['area']
+        fused = False
+
+        #----------------KJL 2017_12_14 ---------------------------
+
+        dx = max_x - min_x
+        dy = max_y - min_y
+        max_dim = max(dx,dy)
+        fuse_blobs_across = max_dim*self.min_interblob_spacing
+        for other_index, other_blob in enumerate(blob_list):
+
+            other_x, other_y = other_blob['centroid_x'], other_blob['centroid_y']
+
+            if np.sqrt((centroid_x-other_x)**2 + (centroid_y-other_y)**2) < fuse_blobs_across:
+
+                fused = True
+                new_centroid_x = (centroid_x + other_x)/2 #could be cheesy-- I'm just averaging the centroids
+                new_centroid_y = (centroid_y + other_y)/2
+                new_area = area + other_blob['area']
+                new_min_x = min(min_x, other_blob['min_x'])
+                new_min_y = min(min_y, other_blob['min_y'])
+                new_max_x = max(max_x, other_blob['max_x'])
+                new_max_y = max(max_y, other_blob['max_y'])
+                fused_blob = {
+                        'centroid_x' : new_centroid_x,
+                        'centroid_y' : new_centroid_y,
+                        'min_x'      : new_min_x,
+                        'max_x'      : new_max_x,
+                        'min_y'      : new_min_y,
+                        'max_y'      : new_max_y,
+                        'area'       : new_area,}
+                blob_list[other_index] = fused_blob
+
+        #----------------KJL 2017_12_14 -----------------------------
+        return fused
+
+    def fuse_blob_array(self, blob_array):
+        """
+        Fuses clusters of nearby blobs in array of blobs with dtype BLOB_DTYPE. Two blobs
+        are in the same cluster if their centroids are closer than min_interblob_spacing
+        times the largest dimension of either blob, and clusters are formed transitively.
+        Each cluster is replaced by one blob with the total area, the area weighted
+        centroid and the bounding box of the cluster. Returns array of fused blobs ordered
+        by the first blob of each cluster.
+        """
+        num_blobs = blob_array.shape[0]
+        if num_blobs < 2 or self.min_interblob_spacing <= 0:
+            return blob_array
+
+        dx = blob_array['max_x'] - blob_array['min_x']
+        dy = blob_array['max_y'] - blob_array['min_y']
+        fuse_dist = np.maximum(dx,dy)*self.min_interblob_spacing
+        pos = np.column_stack((blob_array['centroid_x'], blob_array['centroid_y']))
+
+        index0, index1, dist = variable_radius_self_pairs(pos, fuse_dist)
+        labels = cluster_labels(num_blobs, index0, index1)
+        first_index, labels = np.unique(labels, return_inverse=True)
+        if first_index.size == num_blobs:
+            return blob_array
+
+        fused_array = blob_array[first_index]
+        area = np.bincount(labels, weights=blob_array['area'])
+        # Clusters with no area get the plain mean centroid
+        weight = np.where(area[labels] > 0, blob_array['area'], 1.0)
+        weight_sum = np.bincount(labels, weights=weight)
+        fused_array['centroid_x'] = np.bincount(labels, weights=weight*blob_array['centroid_x'])/weight_sum
+        fused_array['centroid_y'] = np.bincount(labels, weights=weight*blob_array['centroid_y'])/weight_sum
+        fused_array['area'] = area
+        # Field views, updated in place
+        for key in ('min_x', 'min_y'):
+            np.minimum.at(fused_array[key], labels, blob_array[key])
+        for key in ('max_x', 'max_y'):
+            np.maximum.at(fused_array[key], labels, blob_array[key])
+        return fused_array
+
+    def draw_circles(self, image, blob_list):
+        """
+        Returns color copy of gray scale image with tracking circles drawn around blobs
+        """
         circ_image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) 
         for blob in blob_list:
             dx = abs(blob['max_x'] - blob['min_x'])
@@ -146,8 +333,7 @@ class BlobFinder:
             circ_pos = (int(blob['centroid_x']), int(blob['centroid_y']))
             circ_color = (0,0,np.iinfo(circ_image.dtype).max)
             circ_image = cv2.circle(circ_image, circ_pos, circ_radius, circ_color)
-
-        return blob_list, blob_image, circ_image
+        return circ_image
 
 
 
@@ -0,0 +1,51 @@
+from __future__ import print_function
+import os
+import json
+import numpy as np
+
+
+def save_checkpoint(filename, metadata, frames):
+    """
+    Saves checkpoint atomically: metadata (json serializable dictionary) and frames
+    (array of the background model's window frames) are written to a temporary file
+    which then replaces filename, so an interrupted save leaves the previous
+    checkpoint in place.
+    """
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        np.savez(f, metadata=np.array(json.dumps(metadata)), frames=frames)
+        f.flush()
+        os.fsync(f.fileno())
+    replace_file(tmp_filename, filename)
+
+
+def load_checkpoint(filename):
+    """
+    Returns metadata and frames saved by save_checkpoint, or None, None if there is no
+    checkpoint file.
+    """
+    if not os.path.exists(filename):
+        return None, None
+    with np.load(filename, allow_pickle=False) as data:
+        metadata = json.loads(str(data['metadata']))
+        frames = np.array(data['frames'])
+    return metadata, frames
+
+
+def replace_file(src, dst):
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        # Python 2, rename replaces dst atomically on posix
+        os.rename(src, dst)
+
+
+def get_segment_file_name(file_name, index):
+    """
+    Returns name of video segment written by the index'th resume of a run, e.g.
+    'tracking_video_seg001.mp4'. Segment 0 is file_name itself.
+    """
+    if index == 0:
+        return file_name
+    base_name, ext = os.path.splitext(file_name)
+    return '{0}_seg{1:03d}{2}'.format(base_name, index, ext)
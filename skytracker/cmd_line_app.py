@@ -9,6 +9,12 @@ def app_main():
     parser = argparse.ArgumentParser(description='Demo application for tracking flies in upward facing cameras')
     parser.add_argument('videofile', help='video file for tracking')
     parser.add_argument('-c','--config', help='json configuration file')
+    parser.add_argument('--headless', action='store_true', help='run without display windows (overlays only rendered for output video)')
+    parser.add_argument('-w','--workers', type=int, default=1, help='number of worker processes, video is split into frame ranges tracked in parallel')
+    parser.add_argument('--profile', action='store_true', help='print time spent in each processing stage when done')
+    parser.add_argument('--stats-file', help='file to which timing and throughput stats are logged periodically as json lines')
+    parser.add_argument('--checkpoint', help='file to which a checkpoint is saved periodically so the run can be resumed')
+    parser.add_argument('--resume', action='store_true', help='resume run from its checkpoint file, if there is one')
     
     args = parser.parse_args()
     
@@ -16,6 +22,21 @@ def app_main():
     if args.config is not None:
         with open(args.config,'r') as f:
             config_dict = json.load(f)
+
+    if config_dict is None:
+        config_dict = {}
+    if args.headless:
+        config_dict['headless'] = True
+    if args.workers > 1:
+        config_dict['workers'] = args.workers
+    if args.profile:
+        config_dict['profile'] = True
+    if args.stats_file is not None:
+        config_dict['stats_file_name'] = args.stats_file
+    if args.checkpoint is not None:
+        config_dict['checkpoint_file_name'] = args.checkpoint
+    if args.resume:
+        config_dict['resume'] = True
     
     tracker = SkyTracker(input_video_name=args.videofile, param=config_dict)
     tracker.run()
@@ -0,0 +1,135 @@
+from __future__ import print_function
+import threading
+import collections
+import cv2
+import numpy as np
+
+
+class FrameSource:
+    """
+    Random access to the frames of a video for interactive viewers such as
+    FrameStepper and TrackVideoCreator.
+
+    Seeking with cv2.CAP_PROP_POS_FRAMES makes OpenCV decode forward from the previous
+    keyframe, which is slow for long gop videos. FrameSource avoids seeking where it
+    can: frames a short way ahead of the current decode position are reached by
+    decoding forward, and each seek decodes a block of frames which are kept in an LRU
+    cache of decoded frames, limited to cache_size bytes. After each request the
+    prefetch_before and prefetch_after frames around it are decoded into the cache in
+    a background thread, so stepping backwards and forwards is served from the cache.
+
+    Frames returned by get_frame are copies and can be drawn on.
+    """
+
+    def __init__(self, video_file, cache_size=512*2**20, prefetch_before=30, prefetch_after=30, max_skip=None):
+        self.video_file = video_file
+        self.cap = cv2.VideoCapture(video_file)
+        self.prefetch_before = prefetch_before
+        self.prefetch_after = prefetch_after
+        self.cache_size = cache_size
+        # Decoding forward is preferred to seeking up to this many frames ahead
+        self.max_skip = max_skip if max_skip is not None else 2*prefetch_after
+
+        # Frame index, read once
+        self.number_of_frames = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+
+        self.cache = collections.OrderedDict()
+        self.cache_bytes = 0
+        self.next_pos = 0    # frame which cap.read will return next
+
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(threading.Lock())
+        self.prefetch_request = None
+        self.closed = False
+        self.prefetch_thread = threading.Thread(target=self.prefetch_loop, name='prefetch')
+        self.prefetch_thread.daemon = True
+        self.prefetch_thread.start()
+
+    def __len__(self):
+        return self.number_of_frames
+
+    def get_frame(self, frame_number):
+        """
+        Returns copy of frame frame_number, or None if it can't be read.
+        """
+        with self.lock:
+            frame = self.cache.get(frame_number)
+            if frame is not None:
+                self.cache.pop(frame_number)
+                self.cache[frame_number] = frame
+            elif frame_number < self.next_pos:
+                # Stepping backwards, cache the block before the frame as well
+                frame = self.decode_frame(frame_number, block_start=frame_number-self.prefetch_before)
+            else:
+                frame = self.decode_frame(frame_number)
+        self.request_prefetch(frame_number)
+        if frame is None:
+            return None
+        return np.array(frame)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.prefetch_thread.join()
+        self.cap.release()
+        self.cache.clear()
+        self.cache_bytes = 0
+
+    def decode_frame(self, frame_number, block_start=None):
+        """
+        Decodes frame, caching it and any frames decoded on the way to it. If a seek
+        is needed and block_start is given the seek is to block_start so that the
+        frames before frame_number are cached too. Must be called with lock held.
+        """
+        if frame_number < 0 or (self.number_of_frames > 0 and frame_number >= self.number_of_frames):
+            return None
+        if frame_number < self.next_pos or frame_number > self.next_pos + self.max_skip:
+            if block_start is None:
+                block_start = frame_number
+            block_start = max(0, min(block_start, frame_number))
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, block_start)
+            self.next_pos = block_start
+        frame = None
+        while self.next_pos <= frame_number:
+            ret, frame = self.cap.read()
+            if not ret:
+                return None
+            self.add_to_cache(self.next_pos, frame)
+            self.next_pos += 1
+        return frame
+
+    def add_to_cache(self, frame_number, frame):
+        if frame_number in self.cache:
+            self.cache_bytes -= self.cache.pop(frame_number).nbytes
+        self.cache[frame_number] = frame
+        self.cache_bytes += frame.nbytes
+        while self.cache_bytes > self.cache_size and len(self.cache) > 1:
+            _, old_frame = self.cache.popitem(last=False)
+            self.cache_bytes -= old_frame.nbytes
+
+    def request_prefetch(self, frame_number):
+        with self.condition:
+            self.prefetch_request = frame_number
+            self.condition.notify()
+
+    def prefetch_loop(self):
+        while True:
+            with self.condition:
+                while self.prefetch_request is None and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                frame_number = self.prefetch_request
+                self.prefetch_request = None
+
+            # Frames after the requested frame first as stepping forward is most common
+            prefetch_list = list(range(frame_number+1, frame_number+self.prefetch_after+1))
+            prefetch_list.extend(range(frame_number-self.prefetch_before, frame_number))
+            for n in prefetch_list:
+                if self.prefetch_request is not None or self.closed:
+                    break    # A new request supersedes this one
+                with self.lock:
+                    if n not in self.cache:
+                        self.decode_frame(n)
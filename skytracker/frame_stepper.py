@@ -4,6 +4,12 @@ import sys
 import cv2
 import numpy as np
 
+from frame_source import FrameSource
+
+try:
+    input_func = raw_input
+except NameError:
+    input_func = input
 
 
 class FrameStepper:
@@ -14,9 +20,9 @@ class FrameStepper:
 
     def run(self):
 
-        cap = cv2.VideoCapture(self.video_file)
+        frame_source = FrameSource(self.video_file)
 
-        num_frames = cap.get(cv2.CAP_PROP_FRAME_COUNT) 
+        num_frames = len(frame_source)
 
         frame_pos = 0 
 
@@ -24,9 +30,8 @@ class FrameStepper:
 
             print('frame_pos: {0}'.format(frame_pos))
 
-            cap.set(cv2.CAP_PROP_POS_FRAMES,frame_pos)
-            ret, frame = cap.read()
-            if not ret:
+            frame = frame_source.get_frame(frame_pos)
+            if frame is None:
                 break
 
             cv2.imshow('frame',frame)
@@ -38,15 +43,15 @@ class FrameStepper:
                 frame_pos += 1
             if wait_key_val == ord('b'):
                 frame_pos -= 1
-	    if wait_key_val == ord('j'):
-		frame_pos = int(raw_input("Jump to frame: ")) 
+            if wait_key_val == ord('j'):
+                frame_pos = int(input_func("Jump to frame: "))
             frame_pos = max(frame_pos,0)
             frame_pos = min(frame_pos,num_frames-1)
 
 
 
         # Clean up
-        cap.release()
+        frame_source.close()
         cv2.destroyAllWindows()
 
 
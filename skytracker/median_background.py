@@ -4,33 +4,317 @@ import numpy as np
 
 
 class MedianBackground:
+    """
+    Median background model over a sliding window of frames.
 
-    def __init__(self,window_size=11, threshold=10):
+    With reuse_buffers the window, background and foreground images are preallocated
+    on the first update and written in place on every update after that, so frames
+    passed to update may be reused by the caller and the background, foreground_mask
+    and foreground arrays are overwritten by the next update.
+
+    Frames are added to the window on every update, but with refresh_interval k > 1
+    the background is only recomputed every k frames, and frames in between are
+    differenced against the last background. With drift_threshold set the background
+    is also recomputed as soon as the mean brightness of any cell of a coarse grid
+    over the frame (drift_grid cells across) differs from that at the last
+    recompute by more than drift_threshold gray levels, so illumination changes and
+    moving clouds are picked up without waiting. The background is recomputed on
+    every frame until the model is ready. If update is given the frame's number in
+    the video the background is recomputed on frames whose number is a multiple of
+    k, so runs over different frame ranges of a video recompute it on the same
+    frames, otherwise every k updates.
+    """
+
+    drift_grid = 16
+
+    def __init__(self,window_size=11, threshold=10, reuse_buffers=False, refresh_interval=1, drift_threshold=None):
         self.window_size = window_size
         self.threshold = threshold
+        self.reuse_buffers = reuse_buffers
+        self.refresh_interval = refresh_interval
+        self.drift_threshold = drift_threshold
         self.reset()
 
-    def update(self,frame):
+    def update(self,frame,frame_number=None):
+        refresh = self.refresh_due(frame, frame_number)
+        if self.reuse_buffers:
+            self.update_window(frame, refresh)
+            self.update_foreground(frame)
+            return
         self.frame_list.append(frame)
         if len(self.frame_list) >= self.window_size:
             self.ready = True
             self.frame_list.pop(0)
 
-        frame_array = np.array(self.frame_list,dtype=np.uint8)
-        self.background = np.median(frame_array,axis=0)
-        self.background = np.array(self.background,dtype=np.uint8)
+        if refresh:
+            frame_array = np.array(self.frame_list,dtype=np.uint8)
+            self.background = np.median(frame_array,axis=0)
+            self.background = np.array(self.background,dtype=np.uint8)
+        self.update_foreground(frame)
+
+    def refresh_due(self,frame,frame_number=None):
+        """
+        Returns True if the background is to be recomputed on this update, see
+        refresh_interval and drift_threshold. Called before frame is added to the
+        window.
+        """
+        if self.refresh_interval <= 1 and self.drift_threshold is None:
+            return True
+        self.since_refresh += 1
+        level = None
+        if self.drift_threshold is not None:
+            level = self.get_brightness_grid(frame)
+        if self.refresh_interval <= 1:
+            scheduled = True
+        elif frame_number is None:
+            scheduled = self.since_refresh >= self.refresh_interval
+        else:
+            scheduled = frame_number%self.refresh_interval == 0
+        refresh = not self.ready or scheduled
+        if level is not None and self.refresh_level is not None:
+            if cv2.norm(level, self.refresh_level, cv2.NORM_INF) > self.drift_threshold:
+                refresh = True
+        if refresh:
+            self.since_refresh = 0
+            self.refresh_level = level
+            self.refresh_count += 1
+        return refresh
 
+    def get_brightness_grid(self,frame):
+        """
+        Returns mean brightness of each cell of a coarse drift_grid x drift_grid grid
+        over frame, used to detect illumination drift. Using cells rather than the
+        mean of the whole frame also picks up local changes such as moving clouds.
+        """
+        grid_size = (min(self.drift_grid, frame.shape[1]), min(self.drift_grid, frame.shape[0]))
+        return cv2.resize(frame, grid_size, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    def update_window(self,frame, refresh=True):
+        """
+        Version of update with the window kept in a preallocated ring buffer
+        """
+        if self.window is None:
+            window_len = max(self.window_size-1, 1)
+            self.window = np.zeros((window_len,) + frame.shape, dtype=np.uint8)
+            self.median_window = np.zeros((window_len,) + frame.shape, dtype=np.uint8)
+            self.median_buffer = np.zeros(frame.shape, dtype=np.float64)
+            self.background = np.zeros(frame.shape, dtype=np.uint8)
+
+        if self.count == self.window.shape[0]:
+            self.ready = True
+        else:
+            self.count += 1
+        self.window[self.window_pos] = frame
+        self.window_pos = (self.window_pos + 1)%self.window.shape[0]
+
+        if not refresh:
+            return
+        # np.median partitions a copy of its input unless allowed to overwrite it
+        median_window = self.median_window[:self.count]
+        np.copyto(median_window, self.window[:self.count])
+        np.median(median_window, axis=0, out=self.median_buffer, overwrite_input=True)
+        np.copyto(self.background, self.median_buffer, casting='unsafe')
+
+    def update_foreground(self,frame):
+        if self.reuse_buffers:
+            self.update_foreground_in_place(frame)
+            return
         # Get foreground  
         diff_frame = cv2.absdiff(frame,self.background)
         # NOTE: replace 255 with max value form dtype
         ret, self.foreground_mask = cv2.threshold(diff_frame, self.threshold, np.iinfo(frame.dtype).max, cv2.THRESH_BINARY)
         self.foreground = cv2.bitwise_and(frame, frame, mask=self.foreground_mask)
 
+    def update_foreground_in_place(self,frame):
+        if self.foreground_mask is None:
+            self.diff_frame = np.zeros(frame.shape, dtype=frame.dtype)
+            self.foreground_mask = np.zeros(frame.shape, dtype=frame.dtype)
+            self.foreground = np.zeros(frame.shape, dtype=frame.dtype)
+        cv2.absdiff(frame, self.background, dst=self.diff_frame)
+        cv2.threshold(self.diff_frame, self.threshold, np.iinfo(frame.dtype).max, cv2.THRESH_BINARY, dst=self.foreground_mask)
+        # Mask is all ones or all zeros so this is the same as masking with it
+        cv2.bitwise_and(frame, self.foreground_mask, dst=self.foreground)
+
+    def window_frames(self):
+        """
+        Returns list of frames in the window, oldest first
+        """
+        if not self.reuse_buffers:
+            return list(self.frame_list)
+        if self.window is None:
+            return []
+        n = self.window.shape[0]
+        start = self.window_pos if self.count == n else 0
+        return [self.window[(start + k)%n] for k in range(self.count)]
+
+    def get_state(self):
+        """
+        Returns state of model, e.g. for checkpointing: dictionary with array of the
+        frames in the window ('frames', oldest first) and the ready flag. When the
+        background isn't recomputed on every frame the last background is appended
+        to the frames ('cached_background') along with the refresh counters.
+        """
+        frames = self.window_frames()
+        state = {'ready': self.ready}
+        lazy = self.refresh_interval > 1 or self.drift_threshold is not None
+        if lazy and self.background is not None:
+            frames = frames + [self.background]
+            state['cached_background'] = True
+            state['since_refresh'] = self.since_refresh
+            state['refresh_level'] = self.refresh_level.tolist() if self.refresh_level is not None else None
+        if frames:
+            state['frames'] = np.array(frames)
+        else:
+            state['frames'] = np.zeros((0,0,0), dtype=np.uint8)
+        return state
+
+    def set_state(self, state):
+        """
+        Restores state from get_state by updating a reset model with the window's
+        frames.
+        """
+        self.reset()
+        frames = state['frames']
+        if state.get('cached_background', False):
+            frames = frames[:-1]
+        for frame in frames:
+            self.update(np.array(frame))
+        self.ready = bool(state['ready'])
+        if state.get('cached_background', False):
+            if self.reuse_buffers:
+                np.copyto(self.background, state['frames'][-1])
+            else:
+                self.background = np.array(state['frames'][-1], dtype=np.uint8)
+            self.since_refresh = state['since_refresh']
+            if state['refresh_level'] is not None:
+                self.refresh_level = np.array(state['refresh_level'], dtype=np.float32)
+            else:
+                self.refresh_level = None
+
     def reset(self):
         self.ready = False
         self.foreground_mask = None
         self.foreground = None
         self.background = None 
         self.frame_list = []
+        self.window = None
+        self.window_pos = 0
+        self.count = 0
+        self.median_window = None
+        self.median_buffer = None
+        self.diff_frame = None
+        self.since_refresh = 0
+        self.refresh_level = None
+        self.refresh_count = 0
+
+
+class IncrementalMedianBackground(MedianBackground):
+    """
+    Median background model which updates the per-pixel median incrementally as one
+    frame enters the window and one leaves, rather than recomputing it from the whole
+    window on every frame. Gives the same background and foreground mask as
+    MedianBackground.
+
+    Frames are kept in a preallocated ring buffer along with a per-pixel sorted copy of
+    the window. On each update the outgoing frame is deleted from and the incoming frame
+    is inserted into the sorted window with elementwise uint8 min/max/compare operations,
+    so the median is read off directly instead of partitioning the whole window. Only
+    uint8 frames are supported. The sorted window is kept up to date on every frame,
+    so refresh_interval and drift_threshold only save reading off the median.
+    """
+
+    def update(self,frame,frame_number=None):
+        if frame.dtype != np.uint8:
+            raise ValueError('IncrementalMedianBackground requires uint8 frames')
+        refresh = self.refresh_due(frame, frame_number)
+        if self.ring is None:
+            self.allocate(frame.shape)
+
+        if self.count == self.ring.shape[0]:
+            # Window is full - delete oldest frame from sorted window
+            self.ready = True
+            self.delete_sorted(self.ring[self.ring_pos])
+            self.count -= 1
+        self.insert_sorted(frame)
+        self.count += 1
 
+        self.ring[self.ring_pos] = frame
+        self.ring_pos = (self.ring_pos + 1)%self.ring.shape[0]
 
+        if not refresh:
+            self.update_foreground(frame)
+            return
+        mid = self.count//2
+        if self.count%2 == 1:
+            if self.reuse_buffers:
+                np.copyto(self.background, self.sorted_window[mid])
+            else:
+                self.background = np.array(self.sorted_window[mid])
+        else:
+            # Same as truncating the mean of the two middle values as np.median does
+            lo = self.sorted_window[mid-1]
+            hi = self.sorted_window[mid]
+            if self.reuse_buffers:
+                tmp = self.tmp_image
+                np.right_shift(lo, 1, out=self.background)
+                np.right_shift(hi, 1, out=tmp)
+                np.add(self.background, tmp, out=self.background)
+                np.bitwise_and(lo, hi, out=tmp)
+                np.bitwise_and(tmp, 1, out=tmp)
+                np.add(self.background, tmp, out=self.background)
+            else:
+                self.background = (lo >> 1) + (hi >> 1) + (lo & hi & 1)
+        self.update_foreground(frame)
+
+    def delete_sorted(self, frame):
+        """
+        Removes one occurrence of each pixel value in frame from the sorted window.
+        Entries below the removed value stay put and those above it shift down one.
+        """
+        window = self.sorted_window
+        tmp = self.tmp_image
+        for k in range(self.count-1):
+            # window[k] if window[k] < frame else window[k+1]
+            cv2.compare(window[k], frame, cv2.CMP_GE, dst=tmp)
+            cv2.min(window[k+1], tmp, dst=tmp)
+            cv2.max(window[k], tmp, dst=window[k])
+
+    def insert_sorted(self, frame):
+        """
+        Inserts pixel values in frame into the sorted window. Entries below the new
+        value stay put and those above it shift up one.
+        """
+        window = self.sorted_window
+        tmp = self.tmp_image
+        n = self.count
+        if n == 0:
+            window[0] = frame
+            return
+        cv2.max(window[n-1], frame, dst=window[n])
+        for k in range(n-1, 0, -1):
+            cv2.min(window[k], frame, dst=tmp)
+            cv2.max(window[k-1], tmp, dst=window[k])
+        cv2.min(window[0], frame, dst=window[0])
+
+    def window_frames(self):
+        if self.ring is None:
+            return []
+        n = self.ring.shape[0]
+        start = self.ring_pos if self.count == n else 0
+        return [self.ring[(start + k)%n] for k in range(self.count)]
+
+    def allocate(self, shape):
+        ring_size = max(self.window_size-1, 1)
+        self.ring = np.zeros((ring_size,) + shape, dtype=np.uint8)
+        self.sorted_window = np.zeros((ring_size,) + shape, dtype=np.uint8)
+        self.tmp_image = np.zeros(shape, dtype=np.uint8)
+        if self.reuse_buffers:
+            self.background = np.zeros(shape, dtype=np.uint8)
+
+    def reset(self):
+        MedianBackground.reset(self)
+        self.ring = None
+        self.ring_pos = 0
+        self.count = 0
+        self.sorted_window = None
+        self.tmp_image = None
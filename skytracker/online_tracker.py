@@ -0,0 +1,103 @@
+from __future__ import print_function
+import numpy as np
+
+from spatial_tools import match_points
+
+
+class OnlineTracker:
+    """
+    Builds tracks while blobs are being found, rather than matching and stitching the
+    blob data after the video has been processed. Each frame's blobs are matched
+    against the last blob of each active track, see spatial_tools.match_points. Tracks
+    which go unmatched for more than max_missed consecutive frames are closed and, if
+    they have at least min_length points, passed to the track writer (if any) and
+    returned by update. Only the active tracks are kept in memory.
+
+    Tracks are lists of {'frame': frame, 'blob': blob} items, as from BlobStitcher,
+    except that they may skip up to max_missed frames.
+    """
+
+    def __init__(self, max_dist=300, max_missed=2, min_length=2, method='greedy', track_writer=None):
+        self.max_dist = max_dist
+        self.max_missed = max_missed
+        self.min_length = min_length
+        self.method = method
+        self.track_writer = track_writer
+        self.reset()
+
+    def reset(self):
+        self.active_tracks = []
+        self.missed_counts = []
+        self.last_positions = np.zeros((0,2))
+
+    def update(self, frame, blob_list):
+        """
+        Adds blobs found in frame. Returns list of tracks closed by this frame.
+        """
+        blob_positions = np.zeros((len(blob_list),2))
+        blob_positions[:,0] = [blob['centroid_x'] for blob in blob_list]
+        blob_positions[:,1] = [blob['centroid_y'] for blob in blob_list]
+
+        track_index, blob_index = match_points(self.last_positions, blob_positions, self.max_dist, self.method)
+        track_matched = np.zeros((len(self.active_tracks),), dtype=bool)
+        track_matched[track_index] = True
+        blob_matched = np.zeros((len(blob_list),), dtype=bool)
+        blob_matched[blob_index] = True
+
+        for i, j in zip(track_index.tolist(), blob_index.tolist()):
+            self.active_tracks[i].append({'frame': frame, 'blob': blob_list[j]})
+            self.missed_counts[i] = 0
+
+        active_tracks = []
+        missed_counts = []
+        closed_tracks = []
+        for track, missed_count, matched in zip(self.active_tracks, self.missed_counts, track_matched):
+            if not matched:
+                missed_count += 1
+            if missed_count > self.max_missed:
+                closed_tracks.append(track)
+            else:
+                active_tracks.append(track)
+                missed_counts.append(missed_count)
+
+        # Unmatched blobs start new tracks
+        for j in np.flatnonzero(~blob_matched).tolist():
+            active_tracks.append([{'frame': frame, 'blob': blob_list[j]}])
+            missed_counts.append(0)
+
+        self.active_tracks = active_tracks
+        self.missed_counts = missed_counts
+        self.last_positions = np.array([
+            (track[-1]['blob']['centroid_x'], track[-1]['blob']['centroid_y']) for track in active_tracks
+            ]).reshape(-1,2)
+
+        return self.output_tracks(closed_tracks)
+
+    def get_state(self):
+        """
+        Returns active tracks and missed frame counts, e.g. for checkpointing
+        """
+        return {'active_tracks': self.active_tracks, 'missed_counts': self.missed_counts}
+
+    def set_state(self, state):
+        self.active_tracks = [list(track) for track in state['active_tracks']]
+        self.missed_counts = list(state['missed_counts'])
+        self.last_positions = np.array([
+            (track[-1]['blob']['centroid_x'], track[-1]['blob']['centroid_y']) for track in self.active_tracks
+            ]).reshape(-1,2)
+
+    def finish(self):
+        """
+        Closes all active tracks, e.g. at the end of the video. Returns list of closed
+        tracks.
+        """
+        closed_tracks = self.active_tracks
+        self.reset()
+        return self.output_tracks(closed_tracks)
+
+    def output_tracks(self, closed_tracks):
+        track_list = [track for track in closed_tracks if len(track) >= self.min_length]
+        if self.track_writer is not None:
+            for track in track_list:
+                self.track_writer.write(track)
+        return track_list
@@ -0,0 +1,101 @@
+from __future__ import print_function
+import sys
+import time
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class StageCounter:
+    """
+    Throughput counter for one stage of the tracking pipeline. Busy time is the time
+    spent doing the stage's own work and wait time is the time spent blocked on its
+    input or output queue, so the stage with the least wait time is the one limiting
+    throughput.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.busy_time = 0.0
+        self.wait_time = 0.0
+
+    def fps(self):
+        """
+        Returns frames per second the stage could sustain if it never waited
+        """
+        if self.busy_time <= 0:
+            return 0.0
+        return self.count/self.busy_time
+
+    def __str__(self):
+        return '{0:<8s} frames: {1:6d}, busy: {2:8.2f}s, wait: {3:8.2f}s, fps: {4:8.1f}'.format(
+                self.name, self.count, self.busy_time, self.wait_time, self.fps())
+
+
+class StageThread(threading.Thread):
+    """
+    Runs one pipeline stage in its own thread. Any exception raised by the stage is
+    kept so that it can be re-raised in the main thread by check().
+    """
+
+    def __init__(self, name, target):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.target = target
+        self.error = None
+
+    def run(self):
+        try:
+            self.target()
+        except Exception:
+            self.error = sys.exc_info()[1]
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+
+class StageQueue:
+    """
+    Bounded queue between pipeline stages. Blocking operations wake up periodically
+    to check the stop event so that stages can be shut down early, e.g. when the user
+    quits. Time spent blocked is added to the counter's wait time.
+    """
+
+    poll_timeout = 0.1
+
+    def __init__(self, maxsize, stop_event):
+        self.queue = queue.Queue(maxsize)
+        self.stop_event = stop_event
+
+    def put(self, item, counter):
+        t0 = time.time()
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=self.poll_timeout)
+                break
+            except queue.Full:
+                pass
+        counter.wait_time += time.time() - t0
+
+    def get(self, counter):
+        """
+        Returns next item from queue or None if stop event has been set
+        """
+        t0 = time.time()
+        item = None
+        while not self.stop_event.is_set():
+            try:
+                item = self.queue.get(timeout=self.poll_timeout)
+                break
+            except queue.Empty:
+                pass
+        counter.wait_time += time.time() - t0
+        return item
+
+    def qsize(self):
+        return self.queue.qsize()
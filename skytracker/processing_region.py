@@ -0,0 +1,118 @@
+from __future__ import print_function
+import cv2
+import numpy as np
+
+from blob_data_tools import blob_list_to_records
+from blob_data_tools import blob_records_to_list
+
+
+class ProcessingRegion:
+    """
+    Part of the frame on which background subtraction and blob finding are done, and
+    the mapping from it back to full frame coordinates.
+
+    The frame is cropped to the region of interest roi ({'x': x, 'y': y, 'w': w,
+    'h': h} in frame pixels, None for the whole frame) and, if polygon is given, to
+    the bounding box of the polygon (list of [x, y] frame pixel positions). The crop is
+    then reduced in size by the integer decimation factor, averaging blocks of
+    decimation x decimation pixels, and pixels outside the polygon are set to zero so
+    that they never appear in the foreground mask.
+
+    With reuse_buffers the gray scale and reduced images are written to preallocated
+    buffers which are overwritten by the next frame.
+    """
+
+    def __init__(self, frame_shape, roi=None, polygon=None, decimation=1, reuse_buffers=False):
+        frame_h, frame_w = frame_shape[:2]
+        if int(decimation) != decimation or decimation < 1:
+            raise ValueError('decimation must be a positive integer, got {0}'.format(decimation))
+        self.decimation = int(decimation)
+        self.frame_shape = (frame_h, frame_w)
+
+        x0, y0, x1, y1 = 0, 0, frame_w, frame_h
+        if roi is not None:
+            x0 = max(x0, roi['x'])
+            y0 = max(y0, roi['y'])
+            x1 = min(x1, roi['x'] + roi['w'])
+            y1 = min(y1, roi['y'] + roi['h'])
+        polygon_points = None
+        if polygon is not None:
+            polygon_points = np.asarray(polygon, dtype=np.float64).reshape(-1,2)
+            x0 = max(x0, int(np.floor(polygon_points[:,0].min())))
+            y0 = max(y0, int(np.floor(polygon_points[:,1].min())))
+            x1 = min(x1, int(np.ceil(polygon_points[:,0].max())) + 1)
+            y1 = min(y1, int(np.ceil(polygon_points[:,1].max())) + 1)
+
+        # Crop size is a multiple of the decimation factor
+        d = self.decimation
+        x1 = x0 + ((x1 - x0)//d)*d
+        y1 = y0 + ((y1 - y0)//d)*d
+        if x1 <= x0 or y1 <= y0:
+            raise ValueError('processing region is empty')
+        self.x0, self.y0, self.x1, self.y1 = x0, y0, x1, y1
+        self.shape = ((y1 - y0)//d, (x1 - x0)//d)
+
+        self.mask = None
+        if polygon_points is not None:
+            points = np.round((polygon_points - (x0, y0))/d).astype(np.int32)
+            self.mask = np.zeros(self.shape, dtype=np.uint8)
+            cv2.fillPoly(self.mask, [points], 255)
+
+        self.is_full_frame = (
+                self.shape == self.frame_shape and
+                self.mask is None
+                )
+
+        self.reuse_buffers = reuse_buffers
+        self.gray_buffer = None
+        self.reduced_buffer = None
+        if reuse_buffers:
+            self.gray_buffer = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+            self.reduced_buffer = np.zeros(self.shape, dtype=np.uint8)
+
+    def crop(self, frame):
+        """
+        Returns view of frame cropped to the bounding box of the region
+        """
+        return frame[self.y0:self.y1, self.x0:self.x1]
+
+    def to_gray(self, image):
+        """
+        Converts cropped BGR image to gray scale
+        """
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=self.gray_buffer)
+
+    def reduce(self, image):
+        """
+        Returns cropped (as from crop) gray scale image decimated and with the polygon
+        mask applied.
+        """
+        if self.decimation > 1:
+            image = cv2.resize(image, (self.shape[1], self.shape[0]), dst=self.reduced_buffer, interpolation=cv2.INTER_AREA)
+        if self.mask is not None:
+            dst = image if self.reuse_buffers else None
+            image = cv2.bitwise_and(image, self.mask, dst=dst)
+        return image
+
+    def map_blob_array(self, blob_array):
+        """
+        Returns copy of array of blobs (dtype BLOB_DTYPE) found on the reduced image
+        with centroids, bounding boxes and areas in full frame pixels.
+        """
+        d = self.decimation
+        blob_array = np.array(blob_array)
+        # Pixel centres of the reduced image are at the centres of the blocks
+        blob_array['centroid_x'] = self.x0 + (blob_array['centroid_x'] + 0.5)*d - 0.5
+        blob_array['centroid_y'] = self.y0 + (blob_array['centroid_y'] + 0.5)*d - 0.5
+        for key in ('min_x', 'max_x'):
+            blob_array[key] = self.x0 + blob_array[key]*d
+        for key in ('min_y', 'max_y'):
+            blob_array[key] = self.y0 + blob_array[key]*d
+        blob_array['area'] *= d*d
+        return blob_array
+
+    def map_blob_list(self, blob_list):
+        """
+        Version of map_blob_array for lists of blob dictionaries
+        """
+        return blob_records_to_list(self.map_blob_array(blob_list_to_records(blob_list)))
@@ -1,11 +1,32 @@
 from __future__ import print_function
-import sys
+import os
 import cv2
-import json
+import time
+import threading
+import multiprocessing
 import numpy as np
 
 from median_background import MedianBackground
+from median_background import IncrementalMedianBackground
+from background_models import RunningMedianBackground
+from background_models import RunningAverageBackground
+from background_models import MOG2Background
+from background_models import KNNBackground
 from blob_finder import BlobFinder
+from blob_data_tools import merge_blob_files
+from blob_data_tools import delete_blob_file
+from blob_data_tools import create_blob_writer
+from blob_data_tools import iter_blob_data
+from blob_data_tools import TrackWriter
+from online_tracker import OnlineTracker
+from processing_region import ProcessingRegion
+from tracker_stats import TrackerStats
+from checkpoint import save_checkpoint
+from checkpoint import load_checkpoint
+from checkpoint import get_segment_file_name
+from pipeline import StageCounter
+from pipeline import StageThread
+from pipeline import StageQueue
 
 
 
@@ -13,8 +34,16 @@ class SkyTracker:
 
     default_param = {
             'bg_window_size': 11,
+            'bg_model': 'median',
+            'bg_learning_rate': None,
+            'bg_refresh_interval': 1,
+            'bg_drift_threshold': None,
             'fg_threshold': 10,
             'datetime_mask': {'x': 410, 'y': 20, 'w': 500, 'h': 40}, 
+            'roi': None,
+            'roi_polygon': None,
+            'decimation': 1,
+            'reuse_buffers': False,
             'min_area': 0, 
             'max_area': 100000,
             'open_kernel_size': (3,3),
@@ -23,114 +52,732 @@ class SkyTracker:
             'output_video_name': 'tracking_video.mp4',
             'output_video_fps': 20.0,
             'blob_file_name': 'blob_data.json',
+            'blob_file_format': 'json',
             'show_dev_images' : False,
-            'min_interblob_spacing' : 2
+            'headless': False,
+            'workers': 1,
+            'execution_mode': 'serial',
+            'pipeline_queue_size': 16,
+            'min_interblob_spacing' : 2,
+            'blob_method': 'contour',
+            'fuse_method': 'pairwise',
+            'online_tracking': False,
+            'track_file_name': 'track_data.json',
+            'track_max_dist': 300,
+            'track_max_missed': 2,
+            'track_min_length': 2,
+            'track_method': 'greedy',
+            'progress_interval': 5.0,
+            'stats_file_name': None,
+            'stats_interval': 10.0,
+            'profile': False,
+            'checkpoint_file_name': None,
+            'checkpoint_interval': 1000,
+            'resume': False,
             }
 
     def __init__(self, input_video_name, param=default_param):
         self.input_video_name = input_video_name
-        self.param = self.default_param
+        self.param = dict(self.default_param)
         if param is not None:
             self.param.update(param)
+        # TrackerStats of the last run, None until a run processes frames
+        self.stats = None
 
-    def apply_datetime_mask(self,img):
+    def apply_datetime_mask(self,img,in_place=False):
         x = self.param['datetime_mask']['x']
         y = self.param['datetime_mask']['y']
         w = self.param['datetime_mask']['w']
         h = self.param['datetime_mask']['h']
+        if in_place:
+            img[y:y+h, x:x+w] = 0
+            return img
         img_masked = np.array(img) 
         img_masked[y:y+h, x:x+w] = np.zeros([h,w,3])
         return img_masked
 
-    def run(self):
-
-        cap = cv2.VideoCapture(self.input_video_name)
-
-        bg_model = MedianBackground(
+    def create_background_model(self):
+        """
+        Returns background model selected by the 'bg_model' parameter. 'median' is
+        the full median over the window recomputed every frame, 'incremental_median'
+        gives the same result but updates the median as frames enter and leave the
+        window. The approximate models only keep the background, so their memory and
+        cost per frame don't depend on the window size: 'running_median' moves the
+        background towards each frame by a fixed step, 'running_average' is an
+        exponential running average, and 'mog2' and 'knn' are OpenCV's background
+        subtractors (see background_models). 'bg_learning_rate' sets the step or rate
+        of the approximate models, None for their defaults. 'bg_refresh_interval' and
+        'bg_drift_threshold' make the median models recompute the background less
+        often, see MedianBackground.
+        """
+        bg_model_classes = {
+                'median': MedianBackground,
+                'incremental_median': IncrementalMedianBackground,
+                'running_median': RunningMedianBackground,
+                'running_average': RunningAverageBackground,
+                'mog2': MOG2Background,
+                'knn': KNNBackground,
+                }
+        try:
+            bg_model_class = bg_model_classes[self.param['bg_model']]
+        except KeyError:
+            raise ValueError('unknown bg_model {0}'.format(self.param['bg_model']))
+        kwargs = {}
+        median_model = bg_model_class in (MedianBackground, IncrementalMedianBackground)
+        if self.param['bg_learning_rate'] is not None:
+            if median_model:
+                raise ValueError('bg_learning_rate is not used by bg_model {0}'.format(self.param['bg_model']))
+            kwargs['learning_rate'] = self.param['bg_learning_rate']
+        if self.param['bg_refresh_interval'] != 1 or self.param['bg_drift_threshold'] is not None:
+            if not median_model:
+                raise ValueError('bg_refresh_interval and bg_drift_threshold are only used by the median models')
+            kwargs['refresh_interval'] = self.param['bg_refresh_interval']
+            kwargs['drift_threshold'] = self.param['bg_drift_threshold']
+        return bg_model_class(
                 window_size=self.param['bg_window_size'],
-                threshold=self.param['fg_threshold']
+                threshold=self.param['fg_threshold'],
+                reuse_buffers=self.param['reuse_buffers'],
+                **kwargs
                 )
 
+    def create_blob_finder(self):
+        # Blobs are found on the decimated image but areas are given in frame pixels
+        min_area = self.param['min_area']
+        max_area = self.param['max_area']
+        pixel_area = self.param['decimation']**2
+        if min_area is not None:
+            min_area = min_area/float(pixel_area)
+        if max_area is not None:
+            max_area = max_area/float(pixel_area)
         blob_finder = BlobFinder(
-                filter_by_area=True, 
-                min_area=self.param['min_area'], 
-                max_area=self.param['max_area'],
+                filter_by_area=True,
+                min_area=min_area,
+                max_area=max_area,
                 open_kernel_size = self.param['open_kernel_size'],
                 close_kernel_size = self.param['close_kernel_size'],
                 kernel_shape = self.param['kernel_shape'],
 		#---------KJL 2017_12_15
-                min_interblob_spacing = self.param['min_interblob_spacing'])
+                min_interblob_spacing = self.param['min_interblob_spacing'],
+                blob_method = self.param['blob_method'],
+                fuse_method = self.param['fuse_method'],
+                reuse_buffers = self.param['reuse_buffers'])
+        return blob_finder
+
+    def create_processing_region(self, cap):
+        """
+        Returns ProcessingRegion for the frames of cap given by the 'roi', 'roi_polygon'
+        and 'decimation' parameters.
+        """
+        frame_shape = (
+                int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                )
+        return ProcessingRegion(
+                frame_shape,
+                roi=self.param['roi'],
+                polygon=self.param['roi_polygon'],
+                decimation=self.param['decimation'],
+                reuse_buffers=self.param['reuse_buffers'],
+                )
 
-        # Output files
-        vid = None  
-        blob_fid = None
+    def create_stats(self, cap, start_frame=0, end_frame=None):
+        """
+        Returns TrackerStats for a run over frames [start_frame, end_frame) of cap,
+        reporting progress every 'progress_interval' seconds and logging stats to
+        'stats_file_name' every 'stats_interval' seconds.
+        """
+        number_of_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if end_frame is not None:
+            number_of_frames = min(number_of_frames, end_frame)
+        number_of_frames = max(number_of_frames - start_frame, 0)
+        return TrackerStats(
+                number_of_frames=number_of_frames,
+                progress_interval=self.param['progress_interval'],
+                log_file_name=self.param['stats_file_name'],
+                log_interval=self.param['stats_interval'],
+                )
 
-        if self.param['blob_file_name'] is not None:
-            blob_fid = open(self.param['blob_file_name'], 'w')
+    def close_stats(self, stats):
+        stats.close()
+        if self.param['profile']:
+            print()
+            print(stats.summary())
+
+    def create_video_writer(self, shape, file_name=None):
+        if self.param['output_video_name'] is None:
+            return None
+        if file_name is None:
+            file_name = self.param['output_video_name']
+        vid = cv2.VideoWriter(
+                file_name,
+                0x00000021,    # hack for cv2.VideoWriter_fourcc(*'MP4V')
+                self.param['output_video_fps'],
+                (shape[1], shape[0]),
+                )
+        return vid
+
+    def create_blob_writer(self, state=None):
+        """
+        Returns writer for blob data file in the format given by 'blob_file_format',
+        either 'json' (one json object per frame) or 'binary' (see BinaryBlobWriter).
+        If state is given writing is resumed from it.
+        """
+        if self.param['blob_file_name'] is None:
+            return None
+        return create_blob_writer(self.param['blob_file_name'], self.param['blob_file_format'], state)
+
+    def create_online_tracker(self, state=None):
+        """
+        Returns OnlineTracker writing finished tracks to track_file_name if the
+        'online_tracking' parameter is set, otherwise None. If state (from
+        get_online_tracker_state) is given tracking is resumed from it.
+        """
+        if not self.param['online_tracking']:
+            return None
+        if state is None:
+            state = {'track_writer': None, 'tracker': None}
+        track_writer = None
+        if self.param['track_file_name'] is not None:
+            track_writer = TrackWriter(self.param['track_file_name'], state['track_writer'])
+        online_tracker = OnlineTracker(
+                max_dist=self.param['track_max_dist'],
+                max_missed=self.param['track_max_missed'],
+                min_length=self.param['track_min_length'],
+                method=self.param['track_method'],
+                track_writer=track_writer,
+                )
+        if state['tracker'] is not None:
+            online_tracker.set_state(state['tracker'])
+        return online_tracker
+
+    def get_online_tracker_state(self, online_tracker):
+        track_writer_state = None
+        if online_tracker.track_writer is not None:
+            track_writer_state = online_tracker.track_writer.get_state()
+        return {'track_writer': track_writer_state, 'tracker': online_tracker.get_state()}
+
+    def close_online_tracker(self, online_tracker, finish=True):
+        if finish:
+            online_tracker.finish()
+        if online_tracker.track_writer is not None:
+            online_tracker.track_writer.close()
+
+    def preprocess_frame(self, frame, region):
+        """
+        Applies datetime mask, crops frame to processing region, converts it to gray
+        scale and reduces it (see ProcessingRegion.reduce). With the 'reuse_buffers'
+        parameter the datetime mask is applied to frame in place and the returned
+        image is overwritten by the next call.
+        """
+        frame = self.apply_datetime_mask(frame, in_place=self.param['reuse_buffers'])
+        frame = region.to_gray(region.crop(frame))
+        return region.reduce(frame)
+
+    def map_to_full_frame(self, region, blob_finder, frame, blob_list, circ_image):
+        """
+        Maps blobs found in the processing region to full frame coordinates. If the
+        tracking circle image has been drawn it is redrawn on the full frame.
+        """
+        if region.is_full_frame:
+            return blob_list, circ_image
+        blob_list = region.map_blob_list(blob_list)
+        if circ_image is not None:
+            gray_frame = cv2.cvtColor(self.apply_datetime_mask(frame), cv2.COLOR_BGR2GRAY)
+            circ_image = blob_finder.draw_circles(gray_frame, blob_list)
+        return blob_list, circ_image
+
+    def show_images(self, frame, bg_model, blob_image, circ_image):
+        """
+        Displays preview images. Returns False if user has pressed 'q' to quit.
+        """
+        if self.param['show_dev_images']:
+            cv2.imshow('original',frame)
+            cv2.imshow('background', bg_model.background)
+            cv2.imshow('foreground mask', bg_model.foreground_mask)
+            cv2.imshow('blob_image', blob_image)
+            cv2.imshow('circ_image', circ_image)
+        else:
+            cv2.imshow('circ_image', circ_image)
+
+        wait_key_val = cv2.waitKey(1) & 0xFF
+        return wait_key_val != ord('q')
+
+    def run(self):
+        """
+        Runs tracker on input video. If the 'workers' parameter is greater than one the
+        video is split into frame ranges which are tracked in parallel.
+        """
+        if self.param['workers'] > 1:
+            self.run_parallel(self.param['workers'])
+        else:
+            self.run_range()
+
+    def load_resume_checkpoint(self, start_frame, end_frame):
+        """
+        Returns checkpoint metadata and background frames to resume from if the
+        'resume' parameter is set and there is a checkpoint, otherwise None, None.
+        """
+        if not self.param['resume'] or self.param['checkpoint_file_name'] is None:
+            return None, None
+        checkpoint, frames = load_checkpoint(self.param['checkpoint_file_name'])
+        if checkpoint is None:
+            return None, None
+        run_info = [self.input_video_name, start_frame, end_frame, self.param['bg_model']]
+        checkpoint_run_info = [checkpoint['input_video_name'], checkpoint['start_frame'], checkpoint['end_frame'], checkpoint['bg_model']]
+        if run_info != checkpoint_run_info:
+            raise ValueError('checkpoint {0} is for a different run'.format(self.param['checkpoint_file_name']))
+        return checkpoint, frames
+
+    def write_checkpoint(self, next_frame, start_frame, end_frame, bg_model, blob_writer, online_tracker, video_segments, finished=False):
+        """
+        Saves checkpoint of a run which has processed all frames before next_frame,
+        see run_serial.
+        """
+        bg_state = dict(bg_model.get_state())
+        bg_frames = bg_state.pop('frames')
+        checkpoint = {
+                'input_video_name': self.input_video_name,
+                'start_frame': start_frame,
+                'end_frame': end_frame,
+                'next_frame': next_frame,
+                'finished': finished,
+                'bg_model': self.param['bg_model'],
+                'bg_state': bg_state,
+                'blob_writer': blob_writer.get_state() if blob_writer is not None else None,
+                'online_tracker': self.get_online_tracker_state(online_tracker) if online_tracker is not None else None,
+                'video_segments': video_segments,
+                }
+        save_checkpoint(self.param['checkpoint_file_name'], checkpoint, bg_frames)
+
+    def run_range(self, start_frame=0, end_frame=None):
+        """
+        Runs tracker on frames [start_frame, end_frame) using the execution mode given
+        by the 'execution_mode' parameter, either 'serial' or 'pipeline'.
+        """
+        if self.param['checkpoint_file_name'] is not None and self.param['execution_mode'] != 'serial':
+            raise ValueError('checkpointing requires execution_mode serial')
+        if self.param['execution_mode'] == 'pipeline':
+            self.run_pipeline(start_frame, end_frame)
+        elif self.param['execution_mode'] == 'serial':
+            self.run_serial(start_frame, end_frame)
+        else:
+            raise ValueError('unknown execution_mode {0}'.format(self.param['execution_mode']))
+
+    def get_warmup_frame(self, start_frame):
+        """
+        Returns frame from which the background model is warmed up for a run starting
+        at start_frame: bg_window_size frames before it, and with bg_refresh_interval
+        k > 1 a further k - 1 frames so that the model has a full window on the last
+        refresh before start_frame, as in a run over the whole video.
+        """
+        warmup = self.param['bg_window_size'] + max(self.param['bg_refresh_interval'], 1) - 1
+        return max(0, start_frame - warmup)
+
+    def run_serial(self, start_frame=0, end_frame=None):
+        """
+        Runs tracker on frames [start_frame, end_frame) of the input video in this
+        process. When start_frame > 0 the background model is warmed up on the frames
+        before start_frame (see get_warmup_frame), which are not written to the outputs,
+        so results match those of a run over the whole video.
+
+        If 'checkpoint_file_name' is set a checkpoint is saved every
+        'checkpoint_interval' frames, and when the run ends, with the background
+        model's window, the blob and track file offsets and the online tracker's active
+        tracks. With the 'resume' parameter set a run with a checkpoint continues from
+        it: the blob and track files are truncated to the checkpoint and appended to,
+        and the output video is continued in a new segment file (see
+        checkpoint.get_segment_file_name) as videos can't be appended to.
+        """
+        checkpoint, checkpoint_frames = self.load_resume_checkpoint(start_frame, end_frame)
+        if checkpoint is not None and checkpoint['finished']:
+            print('run already finished, see {0}'.format(self.param['checkpoint_file_name']))
+            return
+
+        cap = cv2.VideoCapture(self.input_video_name)
 
-        frame_count = -1
+        warmup_frame = self.get_warmup_frame(start_frame)
+        first_frame = warmup_frame if checkpoint is None else checkpoint['next_frame']
+        if first_frame > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, first_frame)
+
+        region = self.create_processing_region(cap)
+        bg_model = self.create_background_model()
+        blob_finder = self.create_blob_finder()
+        stats = self.create_stats(cap, max(start_frame, first_frame), end_frame)
+        self.stats = stats
+
+        # Output files
+        vid = None  
+        if checkpoint is None:
+            blob_writer = self.create_blob_writer()
+            online_tracker = self.create_online_tracker()
+            video_segments = []
+        else:
+            print('resuming from frame {0}'.format(first_frame))
+            bg_state = dict(checkpoint['bg_state'])
+            bg_state['frames'] = checkpoint_frames
+            bg_model.set_state(bg_state)
+            blob_writer = self.create_blob_writer(checkpoint['blob_writer'])
+            online_tracker = self.create_online_tracker(checkpoint['online_tracker'])
+            video_segments = checkpoint['video_segments']
+        if self.param['output_video_name'] is not None:
+            video_segments = video_segments + [get_segment_file_name(self.param['output_video_name'], len(video_segments))]
+
+        checkpoint_interval = None
+        if self.param['checkpoint_file_name'] is not None:
+            checkpoint_interval = self.param['checkpoint_interval']
+
+        # Overlays are only rendered if they are displayed or written to video
+        headless = self.param['headless']
+        draw = not headless or self.param['output_video_name'] is not None
+
+        frame_count = first_frame - 1
+        finished = False
 
         while True:
 
-            print('frame count: {0}'.format(frame_count))
+            if checkpoint_interval is not None and frame_count >= first_frame:
+                if (frame_count - first_frame + 1)%checkpoint_interval == 0:
+                    self.write_checkpoint(frame_count + 1, start_frame, end_frame, bg_model, blob_writer, online_tracker, video_segments)
 
             # Get frame, mask and convert to gray scale
-            ret, frame = cap.read()
+            t = time.time()
+            if self.param['reuse_buffers'] and frame_count >= first_frame:
+                ret, frame = cap.read(full_frame)
+            else:
+                ret, frame = cap.read()
             if not ret:
+                finished = True
                 break
             frame_count += 1
+            if end_frame is not None and frame_count >= end_frame:
+                finished = True
+                break
 
-            frame = self.apply_datetime_mask(frame)
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            t = stats.add('decode', t)
 
-            if frame_count == 0 and self.param['output_video_name'] is not None:
-                vid = cv2.VideoWriter(
-                        self.param['output_video_name'],
-                        0x00000021,    # hack for cv2.VideoWriter_fourcc(*'MP4V')
-                        self.param['output_video_fps'],
-                        (frame.shape[1], frame.shape[0]),
-                        )
+            full_frame = frame
+            frame = self.preprocess_frame(frame, region)
 
+            if frame_count == first_frame and video_segments:
+                vid = self.create_video_writer(region.frame_shape, video_segments[-1])
+            t = stats.add('preprocess', t)
 
             # Update background model 
-            bg_model.update(frame)
-            if not bg_model.ready:
+            bg_model.update(frame, frame_count)
+            t = stats.add('background', t)
+            if not bg_model.ready or frame_count < start_frame:
+                if frame_count >= start_frame:
+                    stats.frame_done(frame_count)
                 continue
 
             # Find blobs and add data to blob file
-            blob_list, blob_image, circ_image = blob_finder.find(frame,bg_model.foreground_mask)
+            blob_list, blob_image, circ_image = blob_finder.find(frame,bg_model.foreground_mask,draw=draw)
+            blob_list, circ_image = self.map_to_full_frame(region, blob_finder, full_frame, blob_list, circ_image)
+            t = stats.add('blob_find', t)
 
             if vid is not None:
                 vid.write(circ_image)
+                t = stats.add('video_write', t)
 
-            if blob_fid is not None:
-                frame_data = {'frame': frame_count, 'blobs' : blob_list} 
-                frame_data_json = json.dumps(frame_data)
-                blob_fid.write('{0}\n'.format(frame_data_json))
-
-            # Display preview images
-            if self.param['show_dev_images']:
-                cv2.imshow('original',frame)
-                cv2.imshow('background', bg_model.background)
-                cv2.imshow('foreground mask', bg_model.foreground_mask)
-                cv2.imshow('blob_image', blob_image)
-                cv2.imshow('circ_image', circ_image)
-            else:
-                cv2.imshow('circ_image', circ_image)
-                
-            wait_key_val = cv2.waitKey(1) & 0xFF
-            if wait_key_val == ord('q'):
+            if blob_writer is not None:
+                blob_writer.write(frame_count, blob_list)
+                t = stats.add('blob_write', t)
+
+            if online_tracker is not None:
+                online_tracker.update(frame_count, blob_list)
+                t = stats.add('tracking', t)
+
+            running = headless or self.show_images(frame, bg_model, blob_image, circ_image)
+            if not headless:
+                stats.add('render', t)
+            stats.frame_done(frame_count)
+            if not running:
                 break
             
         # Clean up
         cap.release()
-        cv2.destroyAllWindows()
+        if not headless:
+            cv2.destroyAllWindows()
 
         if vid is not None:
             vid.release()
 
-        if blob_fid is not None:
-            blob_fid.close()
+        if checkpoint_interval is not None:
+            # Active tracks of an unfinished run are kept in the checkpoint rather
+            # than written to the track file
+            if finished and online_tracker is not None:
+                online_tracker.finish()
+            next_frame = frame_count if finished else frame_count + 1
+            self.write_checkpoint(next_frame, start_frame, end_frame, bg_model, blob_writer,
+                    online_tracker, video_segments, finished)
+
+        if blob_writer is not None:
+            blob_writer.close()
+
+        if online_tracker is not None:
+            self.close_online_tracker(online_tracker, finish=finished or checkpoint_interval is None)
+
+        self.close_stats(stats)
+
+    def run_pipeline(self, start_frame=0, end_frame=None):
+        """
+        Runs tracker on frames [start_frame, end_frame) as a pipeline of three stages
+        connected by bounded queues: decoding in one thread, masking/background/blob
+        finding in the main thread and output writing (video encoding, blob data and
+        online tracking) in another thread. Gives the same outputs as run_serial.
+        Per-stage throughput counters are kept in self.stage_counters and printed when
+        the run finishes. Stage timings and queue depths are also kept in self.stats.
+        """
+        cap = cv2.VideoCapture(self.input_video_name)
+
+        warmup_frame = self.get_warmup_frame(start_frame)
+        if warmup_frame > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, warmup_frame)
+
+        region = self.create_processing_region(cap)
+        bg_model = self.create_background_model()
+        blob_finder = self.create_blob_finder()
+        stats = self.create_stats(cap, start_frame, end_frame)
+        self.stats = stats
+
+        headless = self.param['headless']
+        draw = not headless or self.param['output_video_name'] is not None
+
+        self.stage_counters = {
+                'decode': StageCounter('decode'),
+                'process': StageCounter('process'),
+                'write': StageCounter('write'),
+                }
+        decode_counter = self.stage_counters['decode']
+        process_counter = self.stage_counters['process']
+        write_counter = self.stage_counters['write']
+
+        # Decoding is stopped when the user quits, writing only on errors so that
+        # processed frames are still written out.
+        quit_event = threading.Event()
+        abort_event = threading.Event()
+        decode_queue = StageQueue(self.param['pipeline_queue_size'], quit_event)
+        write_queue = StageQueue(self.param['pipeline_queue_size'], abort_event)
+        stats.add_queue('decode', decode_queue)
+        stats.add_queue('write', write_queue)
+
+        def decode():
+            try:
+                frame_count = warmup_frame - 1
+                while not quit_event.is_set():
+                    t0 = time.time()
+                    ret, frame = cap.read()
+                    decode_counter.busy_time += stats.add('decode', t0) - t0
+                    if not ret:
+                        break
+                    frame_count += 1
+                    if end_frame is not None and frame_count >= end_frame:
+                        break
+                    decode_counter.count += 1
+                    decode_queue.put((frame_count, frame), decode_counter)
+                decode_queue.put(None, decode_counter)
+            except Exception:
+                quit_event.set()
+                abort_event.set()
+                raise
+
+        def write():
+            vid = None
+            blob_writer = self.create_blob_writer()
+            online_tracker = self.create_online_tracker()
+            try:
+                while True:
+                    item = write_queue.get(write_counter)
+                    if item is None:
+                        break
+                    t0 = time.time()
+                    t = t0
+                    frame_count, blob_list, circ_image = item
+                    if vid is None and circ_image is not None:
+                        vid = self.create_video_writer(circ_image.shape)
+                    if vid is not None:
+                        vid.write(circ_image)
+                        t = stats.add('video_write', t)
+                    if blob_writer is not None:
+                        blob_writer.write(frame_count, blob_list)
+                        t = stats.add('blob_write', t)
+                    if online_tracker is not None:
+                        online_tracker.update(frame_count, blob_list)
+                        t = stats.add('tracking', t)
+                    write_counter.busy_time += t - t0
+                    write_counter.count += 1
+                    stats.frame_done(frame_count)
+            except Exception:
+                quit_event.set()
+                abort_event.set()
+                raise
+            finally:
+                if vid is not None:
+                    vid.release()
+                if blob_writer is not None:
+                    blob_writer.close()
+                if online_tracker is not None:
+                    self.close_online_tracker(online_tracker)
+
+        decode_thread = StageThread('decode', decode)
+        write_thread = StageThread('write', write)
+        decode_thread.start()
+        write_thread.start()
+
+        try:
+            while True:
+                item = decode_queue.get(process_counter)
+                if item is None:
+                    break
+                t0 = time.time()
+                frame_count, frame = item
+
+                full_frame = frame
+                frame = self.preprocess_frame(frame, region)
+                t = stats.add('preprocess', t0)
+                bg_model.update(frame, frame_count)
+                t = stats.add('background', t)
+                if not bg_model.ready or frame_count < start_frame:
+                    process_counter.busy_time += t - t0
+                    process_counter.count += 1
+                    if frame_count >= start_frame:
+                        stats.frame_done(frame_count)
+                    continue
+
+                blob_list, blob_image, circ_image = blob_finder.find(frame,bg_model.foreground_mask,draw=draw)
+                blob_list, circ_image = self.map_to_full_frame(region, blob_finder, full_frame, blob_list, circ_image)
+                if self.param['output_video_name'] is None:
+                    circ_image_out = None
+                else:
+                    circ_image_out = circ_image
+                t = stats.add('blob_find', t)
+                process_counter.busy_time += t - t0
+                process_counter.count += 1
+
+                write_queue.put((frame_count, blob_list, circ_image_out), process_counter)
+
+                if not headless:
+                    t = time.time()
+                    running = self.show_images(frame, bg_model, blob_image, circ_image)
+                    stats.add('render', t)
+                    if not running:
+                        quit_event.set()
+                        break
+        except Exception:
+            quit_event.set()
+            abort_event.set()
+            raise
+        finally:
+            write_queue.put(None, process_counter)
+            decode_thread.join()
+            write_thread.join()
+            cap.release()
+            if not headless:
+                cv2.destroyAllWindows()
+            stats.close()
+
+        decode_thread.check()
+        write_thread.check()
+
+        print()
+        print('pipeline stage throughput')
+        for name in ('decode', 'process', 'write'):
+            print('  {0}'.format(self.stage_counters[name]))
+        self.close_stats(stats)
+
+    def run_parallel(self, num_workers):
+        """
+        Splits input video into frame ranges which are tracked in a pool of worker
+        processes. The per-range blob files are merged into a single blob file ordered
+        by frame. Each worker writes its own segment of the output video, named by
+        adding '_partNNN' to output_video_name, and its own stats log named in the same
+        way. Workers always run headless. With 'checkpoint_file_name' set each worker
+        checkpoints its range to its own '_partNNN' file, so an interrupted parallel run
+        can be resumed range by range.
+
+        With online tracking the tracks are built from the merged blob file once all
+        workers are done, so they are the same as for a serial run.
+        """
+        if self.param['online_tracking'] and self.param['blob_file_name'] is None:
+            raise ValueError('online tracking with multiple workers requires a blob_file_name')
+
+        cap = cv2.VideoCapture(self.input_video_name)
+        number_of_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+
+        # Keep chunks long enough that background warm up isn't most of the work
+        min_chunk_size = 2*self.param['bg_window_size']
+        num_chunks = min(num_workers, number_of_frames//max(min_chunk_size,1))
+        if num_chunks <= 1:
+            self.run_range()
+            return
+
+        chunk_bounds = np.linspace(0, number_of_frames, num_chunks+1).astype(int)
+        job_list = []
+        for index, (start_frame, end_frame) in enumerate(zip(chunk_bounds[:-1], chunk_bounds[1:])):
+            chunk_param = dict(self.param)
+            chunk_param['workers'] = 1
+            chunk_param['headless'] = True
+            chunk_param['online_tracking'] = False
+            if self.param['blob_file_name'] is not None:
+                chunk_param['blob_file_name'] = '{0}.part{1:03d}'.format(self.param['blob_file_name'], index)
+            if self.param['output_video_name'] is not None:
+                chunk_param['output_video_name'] = get_part_file_name(self.param['output_video_name'], index)
+            if self.param['stats_file_name'] is not None:
+                chunk_param['stats_file_name'] = get_part_file_name(self.param['stats_file_name'], index)
+            if self.param['checkpoint_file_name'] is not None:
+                chunk_param['checkpoint_file_name'] = get_part_file_name(self.param['checkpoint_file_name'], index)
+            # The last chunk runs to the end of the video in case frame count is off
+            if index == num_chunks-1:
+                end_frame = None
+            else:
+                end_frame = int(end_frame)
+            job_list.append((self.input_video_name, chunk_param, int(start_frame), end_frame))
+
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            pool.map(run_chunk, job_list)
+        finally:
+            pool.close()
+            pool.join()
+
+        if self.param['blob_file_name'] is not None:
+            part_file_list = [chunk_param['blob_file_name'] for _, chunk_param, _, _ in job_list]
+            merge_blob_files(part_file_list, self.param['blob_file_name'], self.param['blob_file_format'])
+            for part_file in part_file_list:
+                delete_blob_file(part_file)
+
+        # Chunk checkpoints refer to the part files, which are now merged
+        for _, chunk_param, _, _ in job_list:
+            if chunk_param['checkpoint_file_name'] is not None and os.path.exists(chunk_param['checkpoint_file_name']):
+                os.remove(chunk_param['checkpoint_file_name'])
+
+        online_tracker = self.create_online_tracker()
+        if online_tracker is not None:
+            for item in iter_blob_data(self.param['blob_file_name']):
+                online_tracker.update(item['frame'], item['blobs'])
+            self.close_online_tracker(online_tracker)
+
+
+# Utility functions
+# ---------------------------------------------------------------------------------------
+
+def run_chunk(job):
+    """
+    Worker process entry point for SkyTracker.run_parallel
+    """
+    input_video_name, param, start_frame, end_frame = job
+    tracker = SkyTracker(input_video_name=input_video_name, param=param)
+    tracker.run_range(start_frame, end_frame)
+
+
+def get_part_file_name(file_name, index):
+    """
+    Returns name of part file for output file, e.g. 'tracking_video_part002.mp4'
+    """
+    base_name, ext = os.path.splitext(file_name)
+    return '{0}_part{1:03d}{2}'.format(base_name, index, ext)
 
 
 
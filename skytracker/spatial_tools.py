@@ -0,0 +1,232 @@
+from __future__ import print_function
+import numpy
+
+try:
+    from scipy.optimize import linear_sum_assignment
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+except ImportError:
+    linear_sum_assignment = None
+
+
+# Below this number of point pairs distances are computed for all pairs rather than
+# binning points into a grid first.
+DENSE_MAX_PAIRS = 4096
+
+
+def radius_pairs(pos0, pos1, radius):
+    """
+    Returns indices i, j and distances of all pairs of points pos0[i], pos1[j] within
+    radius of each other, sorted by i then j. pos0 and pos1 are (n,2) arrays of x,y
+    positions. For large numbers of points they are binned into a grid with cells of
+    size radius so that only points in neighbouring cells are compared.
+    """
+    pos0 = numpy.asarray(pos0, dtype=numpy.float64).reshape(-1,2)
+    pos1 = numpy.asarray(pos1, dtype=numpy.float64).reshape(-1,2)
+    n0 = pos0.shape[0]
+    n1 = pos1.shape[0]
+
+    if n0 == 0 or n1 == 0:
+        index0 = numpy.zeros((0,), dtype=numpy.intp)
+        index1 = numpy.zeros((0,), dtype=numpy.intp)
+    elif n0*n1 <= DENSE_MAX_PAIRS or not numpy.isfinite(radius) or radius <= 0:
+        index0, index1 = numpy.indices((n0,n1)).reshape(2,-1)
+    else:
+        index0, index1 = grid_candidate_pairs(pos0, pos1, radius)
+
+    delta = pos0[index0] - pos1[index1]
+    dist = numpy.sqrt(delta[:,0]**2 + delta[:,1]**2)
+    mask = dist <= radius
+    index0 = index0[mask]
+    index1 = index1[mask]
+    dist = dist[mask]
+
+    order = numpy.lexsort((index1, index0))
+    return index0[order], index1[order], dist[order]
+
+
+def variable_radius_self_pairs(pos, radius):
+    """
+    Returns indices i < j and distances of all pairs of points pos[i], pos[j] closer
+    than the larger of radius[i] and radius[j], sorted by i then j. Points are grouped
+    into classes whose radii are within a factor of two and the points of each class
+    are compared with all points at the class's largest radius, so a few points with
+    large radii don't make the grid cells large for all the others.
+    """
+    pos = numpy.asarray(pos, dtype=numpy.float64).reshape(-1,2)
+    radius = numpy.asarray(radius, dtype=numpy.float64)
+    num_points = pos.shape[0]
+    index0_list = [numpy.zeros((0,), dtype=numpy.intp)]
+    index1_list = [numpy.zeros((0,), dtype=numpy.intp)]
+    dist_list = [numpy.zeros((0,))]
+
+    # Points with zero radius are only found as neighbours of other points
+    positive = numpy.flatnonzero(radius > 0)
+    size_class = numpy.floor(numpy.log2(radius[positive]))
+    for value in numpy.unique(size_class):
+        members = positive[size_class == value]
+        index0, index1, dist = radius_pairs(pos[members], pos, radius[members].max())
+        index0 = members[index0]
+        mask = (dist < radius[index0]) & (index0 != index1)
+        index0_list.append(numpy.minimum(index0[mask], index1[mask]))
+        index1_list.append(numpy.maximum(index0[mask], index1[mask]))
+        dist_list.append(dist[mask])
+
+    index0 = numpy.concatenate(index0_list)
+    index1 = numpy.concatenate(index1_list)
+    dist = numpy.concatenate(dist_list)
+    # Pairs of points with radii in different classes can be found twice
+    _, unique_index = numpy.unique(index0*num_points + index1, return_index=True)
+    return index0[unique_index], index1[unique_index], dist[unique_index]
+
+
+def cluster_labels(num_points, index0, index1):
+    """
+    Returns cluster label of each point where points are clustered transitively by
+    the pairs index0[k], index1[k]. The label of each cluster is the lowest index of
+    the points in it.
+    """
+    labels = numpy.arange(num_points)
+    if index0.size == 0:
+        return labels
+    while True:
+        # Propagate lowest label across pairs then shortcut chains of labels
+        edge_labels = numpy.minimum(labels[index0], labels[index1])
+        new_labels = labels.copy()
+        numpy.minimum.at(new_labels, index0, edge_labels)
+        numpy.minimum.at(new_labels, index1, edge_labels)
+        new_labels = new_labels[new_labels]
+        while True:
+            next_labels = new_labels[new_labels]
+            if numpy.array_equal(next_labels, new_labels):
+                break
+            new_labels = next_labels
+        if numpy.array_equal(new_labels, labels):
+            return labels
+        labels = new_labels
+
+
+def grid_candidate_pairs(pos0, pos1, cell_size):
+    """
+    Returns indices i, j of all pairs of points pos0[i], pos1[j] in the same or
+    neighbouring cells of a grid with the given cell size.
+    """
+    cell0 = numpy.floor(pos0/cell_size).astype(numpy.int64)
+    cell1 = numpy.floor(pos1/cell_size).astype(numpy.int64)
+    cell_min = numpy.minimum(cell0.min(axis=0), cell1.min(axis=0)) - 1
+    cell0 -= cell_min
+    cell1 -= cell_min
+    num_y = max(cell0[:,1].max(), cell1[:,1].max()) + 2
+
+    # Sort points in pos1 by cell so that points in any cell form a contiguous range
+    key1 = cell1[:,0]*num_y + cell1[:,1]
+    order1 = numpy.argsort(key1, kind='mergesort')
+    key1_sorted = key1[order1]
+
+    index0_list = []
+    index1_list = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            key0 = (cell0[:,0] + dx)*num_y + (cell0[:,1] + dy)
+            start = numpy.searchsorted(key1_sorted, key0, side='left')
+            stop = numpy.searchsorted(key1_sorted, key0, side='right')
+            count = stop - start
+            total = count.sum()
+            if total == 0:
+                continue
+            # Expand each range [start, stop) into the individual pairs
+            index0 = numpy.repeat(numpy.arange(pos0.shape[0]), count)
+            offset = numpy.arange(total) - numpy.repeat(numpy.cumsum(count) - count, count)
+            index1 = order1[numpy.repeat(start, count) + offset]
+            index0_list.append(index0)
+            index1_list.append(index1)
+
+    if not index0_list:
+        return numpy.zeros((0,), dtype=numpy.intp), numpy.zeros((0,), dtype=numpy.intp)
+    return numpy.concatenate(index0_list), numpy.concatenate(index1_list)
+
+
+def match_points(pos0, pos1, max_dist, method='greedy'):
+    """
+    Finds one-to-one matching between points pos0 and pos1 with matched points no more
+    than max_dist apart. Returns arrays of indices i, j of matched pairs pos0[i], pos1[j]
+    ordered by increasing distance.
+
+    method 'greedy' repeatedly matches the closest remaining pair of points. method
+    'optimal' finds the matching with the most pairs and, among those, the least total
+    distance, using scipy's linear_sum_assignment.
+    """
+    index0, index1, dist = radius_pairs(pos0, pos1, max_dist)
+    if method == 'greedy':
+        match0, match1 = greedy_assignment(index0, index1, dist)
+    elif method == 'optimal':
+        match0, match1 = optimal_assignment(index0, index1, dist, max_dist)
+    else:
+        raise ValueError('unknown matching method {0}'.format(method))
+    return match0, match1
+
+
+def greedy_assignment(index0, index1, dist):
+    """
+    Greedy matching of candidate pairs: pairs are taken in order of increasing distance
+    (ties broken by index) if neither point has already been matched.
+    """
+    order = numpy.lexsort((index1, index0, dist))
+    used0 = set()
+    used1 = set()
+    match0 = []
+    match1 = []
+    for i, j in zip(index0[order].tolist(), index1[order].tolist()):
+        if i in used0 or j in used1:
+            continue
+        used0.add(i)
+        used1.add(j)
+        match0.append(i)
+        match1.append(j)
+    return numpy.array(match0, dtype=numpy.intp), numpy.array(match1, dtype=numpy.intp)
+
+
+def optimal_assignment(index0, index1, dist, max_dist):
+    """
+    Maximum cardinality, minimum total distance matching of candidate pairs. Each
+    connected group of candidate pairs is solved separately so the cost matrices stay
+    small even for frames with many points.
+    """
+    if linear_sum_assignment is None:
+        raise ImportError("matching method 'optimal' requires scipy")
+    if index0.size == 0:
+        return index0, index1
+
+    # Label connected groups of points, nodes are points in pos0 then points in pos1
+    node0, inverse0 = numpy.unique(index0, return_inverse=True)
+    node1, inverse1 = numpy.unique(index1, return_inverse=True)
+    num_nodes = node0.size + node1.size
+    graph = coo_matrix((numpy.ones(index0.size), (inverse0, node0.size + inverse1)), shape=(num_nodes, num_nodes))
+    num_groups, labels = connected_components(graph, directed=False)
+    pair_labels = labels[inverse0]
+
+    # Cost of a missing pair is more than any set of real pairs so as many pairs as
+    # possible are matched.
+    big_cost = max_dist*(min(node0.size, node1.size) + 1) + 1.0
+
+    match0_list = []
+    match1_list = []
+    match_dist_list = []
+    order = numpy.argsort(pair_labels, kind='mergesort')
+    bounds = numpy.searchsorted(pair_labels[order], numpy.arange(num_groups+1))
+    for n in range(num_groups):
+        group = order[bounds[n]:bounds[n+1]]
+        rows, row_index = numpy.unique(inverse0[group], return_inverse=True)
+        cols, col_index = numpy.unique(inverse1[group], return_inverse=True)
+        cost = numpy.full((rows.size, cols.size), big_cost)
+        cost[row_index, col_index] = dist[group]
+        row_match, col_match = linear_sum_assignment(cost)
+        ok = cost[row_match, col_match] < big_cost
+        match0_list.append(node0[rows[row_match[ok]]])
+        match1_list.append(node1[cols[col_match[ok]]])
+        match_dist_list.append(cost[row_match[ok], col_match[ok]])
+
+    match0 = numpy.concatenate(match0_list)
+    match1 = numpy.concatenate(match1_list)
+    order = numpy.lexsort((match1, match0, numpy.concatenate(match_dist_list)))
+    return match0[order], match1[order]
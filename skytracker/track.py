@@ -0,0 +1,130 @@
+from __future__ import print_function
+import numpy as np
+
+from blob_data_tools import BLOB_DTYPE
+from blob_data_tools import BLOB_KEYS
+from blob_data_tools import blob_records_to_list
+
+
+class Track(object):
+    """
+    Compact track: the track's points as an array of records with dtype BLOB_DTYPE,
+    i.e. contiguous 'frame', 'centroid_x', 'centroid_y', 'min_x', 'max_x', 'min_y',
+    'max_y' and 'area' columns, instead of a list of {'frame': frame, 'blob': blob}
+    dictionaries. A point takes 64 bytes rather than the roughly 650 bytes of the two
+    dictionaries and boxed values.
+
+    For compatibility with code written for list tracks indexing with an integer and
+    iterating give {'frame': frame, 'blob': blob} items, and slicing gives a Track (a
+    view of the same records). New code should use the columns, e.g. track.frames or
+    track.points['area'].
+    """
+
+    __slots__ = ('points',)
+
+    def __init__(self, points):
+        self.points = points
+
+    @classmethod
+    def from_list(cls, track):
+        """
+        Returns Track with the points of track, a list of {'frame', 'blob'} items
+        """
+        return cls(track_list_to_records([track])[0])
+
+    def to_list(self):
+        """
+        Returns track as a list of {'frame': frame, 'blob': blob} items
+        """
+        frames = self.points['frame'].tolist()
+        blobs = blob_records_to_list(self.points)
+        return [{'frame': frame, 'blob': blob} for frame, blob in zip(frames, blobs)]
+
+    @property
+    def frames(self):
+        return self.points['frame']
+
+    @property
+    def x(self):
+        return self.points['centroid_x']
+
+    @property
+    def y(self):
+        return self.points['centroid_y']
+
+    def __len__(self):
+        return len(self.points)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Track(self.points[index])
+        record = self.points[index]
+        blob = dict((key, float(record[key])) for key in BLOB_KEYS)
+        return {'frame': int(record['frame']), 'blob': blob}
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __repr__(self):
+        if len(self.points) == 0:
+            return 'Track([])'
+        return 'Track({0} points, frames {1}-{2})'.format(len(self.points), self.points['frame'][0], self.points['frame'][-1])
+
+
+def track_list_to_records(track_list):
+    """
+    Returns list of record arrays with dtype BLOB_DTYPE, one per track in track_list,
+    which may hold both list tracks and Tracks. The records of list tracks are views
+    of a single array so converting many short tracks needs one allocation.
+    """
+    list_tracks = [track for track in track_list if not isinstance(track, Track)]
+    lengths = [len(track) for track in list_tracks]
+    records = np.zeros((sum(lengths),), dtype=BLOB_DTYPE)
+    records['frame'] = track_list_column(list_tracks, 'frame')
+    for key in BLOB_KEYS:
+        records[key] = track_list_column(list_tracks, key)
+    list_records = iter(np.split(records, np.cumsum(lengths)[:-1]) if lengths else [])
+    return [track.points if isinstance(track, Track) else next(list_records) for track in track_list]
+
+
+def compact_tracks(track_list):
+    """
+    Returns list of Tracks for track_list of list tracks (or Tracks, which are kept)
+    """
+    return [Track(points) for points in track_list_to_records(track_list)]
+
+
+def expand_tracks(track_list):
+    """
+    Returns list of list tracks for track_list of Tracks (or list tracks, which are
+    kept)
+    """
+    return [track.to_list() if isinstance(track, Track) else track for track in track_list]
+
+
+def track_records(track):
+    """
+    Returns points of track, a Track or list track, as an array of records with dtype
+    BLOB_DTYPE
+    """
+    if isinstance(track, Track):
+        return track.points
+    return track_list_to_records([track])[0]
+
+
+def track_list_column(track_list, key):
+    """
+    Returns array with the values of column key ('frame' or one of BLOB_KEYS) of all
+    points of the tracks in track_list, which may hold both list tracks and Tracks,
+    concatenated in order.
+    """
+    dtype = BLOB_DTYPE[key]
+    if any(isinstance(track, Track) for track in track_list):
+        columns = [track_list_column([track], key) if not isinstance(track, Track) else track.points[key] for track in track_list]
+        return np.concatenate(columns) if columns else np.zeros((0,), dtype=dtype)
+    num_points = sum(len(track) for track in track_list)
+    if key == 'frame':
+        values = (item['frame'] for track in track_list for item in track)
+    else:
+        values = (item['blob'][key] for track in track_list for item in track)
+    return np.fromiter(values, dtype=dtype, count=num_points)
@@ -0,0 +1,359 @@
+from __future__ import print_function
+import os
+import json
+import numpy as np
+
+from track import track_list_column
+from track import compact_tracks
+from blob_data_tools import load_track_data
+
+
+class TrackStore:
+    """
+    Spatiotemporal index of a list of tracks, e.g. from BlobStitcher or
+    load_track_data, for finding the tracks which pass through a region of the image
+    during a range of frames and the tracks nearest to a point.
+
+    Each track is treated as the line segments between its consecutive points (a
+    track with a single point is a segment of zero length), with positions linearly
+    interpolated between frames. The segments are binned into a grid with cells of
+    'cell_size' pixels by 'frame_bin' frames, each segment in every cell its bounding
+    box overlaps, and queries only test the segments in the cells they overlap.
+
+    The index doesn't hold the tracks themselves so it can be saved (see save and
+    load) and reloaded with the track file instead of being rebuilt. Queries return
+    track indices; the tracks_* methods return the tracks when the store was given
+    the track list.
+    """
+
+    default_param = {'cell_size': 64.0, 'frame_bin': 100}
+
+    def __init__(self, track_list=None, param=None):
+        self.param = dict(self.default_param)
+        if param is not None:
+            self.param.update(param)
+        self.track_list = track_list
+        if track_list is not None:
+            self.build(track_list)
+
+    def build(self, track_list):
+        lengths = np.array([len(track) for track in track_list], dtype=np.int64)
+        frames = track_list_column(track_list, 'frame')
+        x_vals = track_list_column(track_list, 'centroid_x')
+        y_vals = track_list_column(track_list, 'centroid_y')
+
+        # Segment from each point to the next point of the same track, and from the
+        # only point of single point tracks to itself
+        ends = np.cumsum(lengths)
+        point_track = np.repeat(np.arange(len(lengths)), lengths)
+        has_next = np.ones(frames.shape, dtype=bool)
+        has_next[ends[lengths > 0] - 1] = False
+        seg_start = np.flatnonzero(has_next | (lengths[point_track] == 1))
+        seg_end = np.where(has_next[seg_start], seg_start + 1, seg_start)
+
+        self.num_tracks = len(lengths)
+        self.num_points = len(frames)
+        self.seg_track = point_track[seg_start]
+        self.seg_frame = np.column_stack((frames[seg_start], frames[seg_end]))
+        self.seg_x = np.column_stack((x_vals[seg_start], x_vals[seg_end]))
+        self.seg_y = np.column_stack((y_vals[seg_start], y_vals[seg_end]))
+        self.build_grid()
+
+    def build_grid(self):
+        """
+        Bins segments into grid cells. The cells holding segments are kept sorted by
+        key, with the segments of cell_keys[n] given by
+        cell_segments[cell_offsets[n]:cell_offsets[n+1]].
+        """
+        lo, hi = self.segment_cells()
+        if len(self.seg_track) > 0:
+            self.grid_origin = lo.min(axis=0)
+            self.grid_shape = hi.max(axis=0) - self.grid_origin + 1
+        else:
+            self.grid_origin = np.zeros((3,), dtype=np.int64)
+            self.grid_shape = np.ones((3,), dtype=np.int64)
+
+        # One (cell, segment) entry per cell of each segment's bounding box
+        extent = hi - lo + 1
+        counts = extent.prod(axis=1)
+        entry_seg = np.repeat(np.arange(len(counts)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cells = np.empty((len(entry_seg), 3), dtype=np.int64)
+        for axis in (2, 1, 0):
+            cells[:,axis] = lo[entry_seg, axis] + local%extent[entry_seg, axis]
+            local = local//extent[entry_seg, axis]
+        keys = self.cell_key(cells)
+
+        order = np.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        self.cell_segments = entry_seg[order]
+        self.cell_keys, first = np.unique(keys, return_index=True)
+        self.cell_offsets = np.append(first, len(keys))
+
+    def segment_cells(self):
+        """
+        Returns (n,3) arrays of the lowest and highest (frame bin, x cell, y cell) of
+        each segment's bounding box
+        """
+        frame_bin = self.param['frame_bin']
+        cell_size = float(self.param['cell_size'])
+        lo = np.column_stack((
+            self.seg_frame.min(axis=1)//frame_bin,
+            np.floor(self.seg_x.min(axis=1)/cell_size),
+            np.floor(self.seg_y.min(axis=1)/cell_size),
+            )).astype(np.int64)
+        hi = np.column_stack((
+            self.seg_frame.max(axis=1)//frame_bin,
+            np.floor(self.seg_x.max(axis=1)/cell_size),
+            np.floor(self.seg_y.max(axis=1)/cell_size),
+            )).astype(np.int64)
+        return lo, hi
+
+    def cell_key(self, cells):
+        cells = cells - self.grid_origin
+        return (cells[:,0]*self.grid_shape[1] + cells[:,1])*self.grid_shape[2] + cells[:,2]
+
+    def segments_in_cells(self, lo, hi):
+        """
+        Returns sorted array of the segments in cells lo <= (frame bin, x cell,
+        y cell) <= hi
+        """
+        lo = np.maximum(lo, self.grid_origin)
+        hi = np.minimum(hi, self.grid_origin + self.grid_shape - 1)
+        if np.any(hi < lo) or len(self.cell_keys) == 0:
+            return np.zeros((0,), dtype=np.int64)
+        extent = hi - lo + 1
+        if extent.prod() <= len(self.cell_keys):
+            # Look up each cell of the query box
+            grid = np.meshgrid(*[np.arange(lo[i], hi[i]+1) for i in range(3)], indexing='ij')
+            keys = self.cell_key(np.column_stack([g.ravel() for g in grid]))
+            pos = np.searchsorted(self.cell_keys, keys)
+            pos = pos[pos < len(self.cell_keys)]
+            keys = keys[:len(pos)]
+            found = pos[self.cell_keys[pos] == keys]
+        else:
+            # Query box has more cells than the grid holds, test the held cells
+            local = self.cell_keys
+            cells = np.empty((len(local), 3), dtype=np.int64)
+            for axis in (2, 1, 0):
+                cells[:,axis] = local%self.grid_shape[axis] + self.grid_origin[axis]
+                local = local//self.grid_shape[axis]
+            found = np.flatnonzero(np.all((cells >= lo) & (cells <= hi), axis=1))
+        if len(found) == 0:
+            return np.zeros((0,), dtype=np.int64)
+        counts = self.cell_offsets[found+1] - self.cell_offsets[found]
+        index = np.repeat(self.cell_offsets[found] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return np.unique(self.cell_segments[index])
+
+    def track_indices_in_region(self, x_min, y_min, x_max, y_max, start_frame=None, end_frame=None):
+        """
+        Returns sorted array of indices of tracks which pass through the box x_min <=
+        x <= x_max, y_min <= y <= y_max in frames [start_frame, end_frame), i.e. with
+        an interpolated position in the box at some time between start_frame and
+        end_frame-1. start_frame and end_frame of None leave the range open.
+        """
+        frame_min = -np.inf if start_frame is None else start_frame
+        frame_max = np.inf if end_frame is None else end_frame - 1
+        cell_size = float(self.param['cell_size'])
+        frame_bin = self.param['frame_bin']
+        big = np.iinfo(np.int64).max//4
+        lo = np.array([
+            -big if start_frame is None else start_frame//frame_bin,
+            np.floor(x_min/cell_size),
+            np.floor(y_min/cell_size),
+            ], dtype=np.int64)
+        hi = np.array([
+            big if end_frame is None else (end_frame - 1)//frame_bin,
+            np.floor(x_max/cell_size),
+            np.floor(y_max/cell_size),
+            ], dtype=np.int64)
+        seg = self.segments_in_cells(lo, hi)
+
+        # Clip each segment's parameter range to the time window and the box
+        s_min = np.zeros(seg.shape)
+        s_max = np.ones(seg.shape)
+        bounds = (
+                (self.seg_frame[seg], frame_min, frame_max),
+                (self.seg_x[seg], x_min, x_max),
+                (self.seg_y[seg], y_min, y_max),
+                )
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for values, v_min, v_max in bounds:
+                v0 = values[:,0].astype(np.float64)
+                dv = values[:,1] - v0
+                moving = dv != 0
+                s0 = np.where(moving, (v_min - v0)/dv, -np.inf)
+                s1 = np.where(moving, (v_max - v0)/dv, np.inf)
+                s_min = np.maximum(s_min, np.minimum(s0, s1))
+                s_max = np.minimum(s_max, np.maximum(s0, s1))
+                s_max[~moving & ((v0 < v_min) | (v0 > v_max))] = -1.0
+        return np.unique(self.seg_track[seg[s_min <= s_max]])
+
+    def tracks_in_region(self, x_min, y_min, x_max, y_max, start_frame=None, end_frame=None):
+        """
+        Returns list of tracks which pass through the box in frames [start_frame,
+        end_frame), see track_indices_in_region
+        """
+        track_indices = self.track_indices_in_region(x_min, y_min, x_max, y_max, start_frame, end_frame)
+        return [self.track_list[i] for i in track_indices]
+
+    def nearest_track_indices(self, x, y, frame=None, k=1, max_dist=None):
+        """
+        Returns indices of up to k tracks nearest to point x, y and their distances,
+        nearest first. If frame is given only tracks with a (interpolated) position in
+        frame are considered and the distance is from that position, otherwise the
+        distance is from the nearest point on any of the track's segments. Tracks
+        further than max_dist are left out.
+        """
+        if frame is None:
+            return self.nearest_track_indices_any_frame(x, y, k, max_dist)
+
+        frame_bin = frame//self.param['frame_bin']
+        big = np.iinfo(np.int64).max//4
+        seg = self.segments_in_cells(np.array([frame_bin, -big, -big]), np.array([frame_bin, big, big]))
+        seg_frame = self.seg_frame[seg]
+        seg = seg[(seg_frame[:,0] <= frame) & (seg_frame[:,1] >= frame)]
+        seg_frame = self.seg_frame[seg]
+        span = seg_frame[:,1] - seg_frame[:,0]
+        s = np.where(span > 0, (frame - seg_frame[:,0])/np.maximum(span, 1).astype(np.float64), 0.0)
+        pos_x = self.seg_x[seg,0] + s*(self.seg_x[seg,1] - self.seg_x[seg,0])
+        pos_y = self.seg_y[seg,0] + s*(self.seg_y[seg,1] - self.seg_y[seg,0])
+        dist = np.sqrt((pos_x - x)**2 + (pos_y - y)**2)
+        return self.nearest_by_track(self.seg_track[seg], dist, k, max_dist)
+
+    def nearest_track_indices_any_frame(self, x, y, k, max_dist):
+        """
+        Searches rings of cells of increasing size around x, y until k tracks are
+        found closer than any segment outside the searched cells can be.
+        """
+        cell_size = float(self.param['cell_size'])
+        cell = np.floor(np.array([x, y])/cell_size).astype(np.int64)
+        big = np.iinfo(np.int64).max//4
+        max_ring = int(np.max(np.abs(np.concatenate((
+            cell - self.grid_origin[1:],
+            cell - (self.grid_origin[1:] + self.grid_shape[1:] - 1),
+            )))))
+        if max_dist is not None:
+            max_ring = min(max_ring, int(np.ceil(max_dist/cell_size)) + 1)
+        ring = 1
+        while True:
+            ring = min(ring, max_ring)
+            lo = np.array([-big, cell[0] - ring, cell[1] - ring])
+            hi = np.array([big, cell[0] + ring, cell[1] + ring])
+            seg = self.segments_in_cells(lo, hi)
+            dist = point_segment_distance(x, y, self.seg_x[seg], self.seg_y[seg])
+            track_indices, track_dist = self.nearest_by_track(self.seg_track[seg], dist, k, max_dist)
+            # Anything outside the searched cells is at least ring*cell_size away
+            if ring >= max_ring or (len(track_indices) == k and track_dist[-1] <= ring*cell_size):
+                return track_indices, track_dist
+            ring *= 2
+
+    def nearest_by_track(self, seg_track, dist, k, max_dist):
+        """
+        Returns indices and distances of the k tracks with the nearest segments
+        """
+        if max_dist is not None:
+            keep = dist <= max_dist
+            seg_track = seg_track[keep]
+            dist = dist[keep]
+        order = np.lexsort((seg_track, dist))
+        track_indices, first = np.unique(seg_track[order], return_index=True)
+        track_dist = dist[order][first]
+        nearest = np.lexsort((track_indices, track_dist))[:k]
+        return track_indices[nearest], track_dist[nearest]
+
+    def nearest_tracks(self, x, y, frame=None, k=1, max_dist=None):
+        """
+        Returns list of up to k tracks nearest to x, y, see nearest_track_indices
+        """
+        track_indices, _ = self.nearest_track_indices(x, y, frame, k, max_dist)
+        return [self.track_list[i] for i in track_indices]
+
+    def save(self, filename):
+        """
+        Saves index to filename (npz format), see load
+        """
+        info = {
+                'param': self.param,
+                'num_tracks': self.num_tracks,
+                'num_points': self.num_points,
+                }
+        with open(filename, 'wb') as f:
+            np.savez(
+                    f,
+                    info=np.array(json.dumps(info)),
+                    seg_track=self.seg_track,
+                    seg_frame=self.seg_frame,
+                    seg_x=self.seg_x,
+                    seg_y=self.seg_y,
+                    grid_origin=self.grid_origin,
+                    grid_shape=self.grid_shape,
+                    cell_keys=self.cell_keys,
+                    cell_offsets=self.cell_offsets,
+                    cell_segments=self.cell_segments,
+                    )
+
+    @classmethod
+    def load(cls, filename, track_list=None):
+        """
+        Returns TrackStore saved by save. If track_list is given it is checked to
+        have the number of tracks and points the index was built from.
+        """
+        with np.load(filename, allow_pickle=False) as data:
+            info = json.loads(str(data['info']))
+            store = cls(param=info['param'])
+            for name in data.files:
+                if name != 'info':
+                    setattr(store, name, np.array(data[name]))
+        store.num_tracks = info['num_tracks']
+        store.num_points = info['num_points']
+        if track_list is not None:
+            num_points = sum(len(track) for track in track_list)
+            if len(track_list) != store.num_tracks or num_points != store.num_points:
+                raise ValueError('track store {0} was built from different tracks'.format(filename))
+            store.track_list = track_list
+        return store
+
+
+def point_segment_distance(x, y, seg_x, seg_y):
+    """
+    Returns distance from point x, y to each line segment from seg_x[:,0], seg_y[:,0]
+    to seg_x[:,1], seg_y[:,1]
+    """
+    dx = seg_x[:,1] - seg_x[:,0]
+    dy = seg_y[:,1] - seg_y[:,0]
+    length_sq = dx**2 + dy**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = ((x - seg_x[:,0])*dx + (y - seg_y[:,0])*dy)/length_sq
+    s = np.clip(np.where(length_sq > 0, s, 0.0), 0.0, 1.0)
+    return np.sqrt((seg_x[:,0] + s*dx - x)**2 + (seg_y[:,0] + s*dy - y)**2)
+
+
+def get_track_store_file_name(track_file_name):
+    return track_file_name + '.store.npz'
+
+
+def load_track_store(track_file_name, param=None, compact=False):
+    """
+    Returns TrackStore of the tracks in track_file_name (written by TrackWriter) with
+    the tracks loaded. The index is loaded from the store file next to the track
+    file, or built and saved there if there is none, it is older than the track file
+    or param differs. If compact is set the tracks are loaded as compact Tracks.
+    """
+    track_list = load_track_data(track_file_name)
+    if compact:
+        track_list = compact_tracks(track_list)
+    store_file_name = get_track_store_file_name(track_file_name)
+    store_param = dict(TrackStore.default_param)
+    if param is not None:
+        store_param.update(param)
+    if os.path.exists(store_file_name) and os.path.getmtime(store_file_name) >= os.path.getmtime(track_file_name):
+        try:
+            store = TrackStore.load(store_file_name, track_list)
+        except ValueError:
+            store = None
+        if store is not None and store.param == store_param:
+            return store
+    store = TrackStore(track_list, store_param)
+    store.save(store_file_name)
+    return store
@@ -1,77 +1,105 @@
 from __future__ import print_function
 import cv2
 import sys
-import copy
 import math
 import numpy
 import skytracker
 import matplotlib.pyplot as plt
+from spatial_tools import match_points
+from frame_source import FrameSource
+from track import Track
+from track import track_records
+from track import track_list_column
 
 
 class BlobMatcher:
     """
     Generates pairwise blob matchings from raw blob data.
+
+    Blobs in consecutive frames are matched with distances computed by numpy and
+    candidate pairs gated at max_dist using a grid, see spatial_tools.match_points.
+    method is either 'greedy', which repeatedly matches the closest remaining pair, or
+    'optimal', which matches as many blobs as possible with least total distance
+    (requires scipy). All frames are matched by default. If max_blobs is set frames
+    with more than max_blobs blobs are not matched, and their frame pairs are added to
+    skipped_frame_pairs.
     """
 
-    default_param = {'max_blobs': 10, 'max_dist': 300}
+    default_param = {'max_blobs': None, 'max_dist': 300, 'method': 'greedy'}
 
     def __init__(self, param=default_param):
-        self.param = param
+        self.param = dict(self.default_param)
+        if param is not None:
+            self.param.update(param)
+        self.skipped_frame_pairs = []
 
     def run(self, blob_data):
         return self.get_match_list(blob_data)
 
     def get_match_list(self,blob_data):
+        return list(self.iter_match_list(blob_data))
 
-        match_list = []
-
-        for curr_item, next_item in zip(blob_data[0:-1],blob_data[1:]):
-
-            curr_frame = curr_item['frame']
-            next_frame = next_item['frame']
-            next_blob_list = next_item['blobs']
-            curr_blob_list = curr_item['blobs']
-
-            num_to_check = len(curr_blob_list)
-            blob_pair_list = []
-
-            # If there aren't too many blobs - check all candidate pairs and select the best matches
-            if num_to_check <= self.param['max_blobs']:
-
-                # Create and sort list of candidate blob pairs
-                candidate_pair_list = []
-                for curr_blob in curr_blob_list:
-                    for next_blob in next_blob_list:
-                        distance = blob_distance(curr_blob, next_blob)
-                        candidate_pair_list.append((distance, (curr_blob, next_blob)))
-                candidate_pair_list.sort()
-
-                # Check blob pairs until we have check all in curr_blob_list
-                while num_to_check > 0:
-                    if len(candidate_pair_list) == 0:
-                        break
-                    distance, blob_pair = candidate_pair_list.pop(0)
-                    if distance <= self.param['max_dist']:
-                        blob_pair_list.append(blob_pair)
-                        # Remove 2nd blob - which was matched to 1st - from list of candidates
-                        candidate_pair_list = [item for item in candidate_pair_list if item[1][1] != blob_pair[1]] 
-                    # Remove 1st blob from list of candidates
-                    candidate_pair_list = [item for item in candidate_pair_list if item[1][0] != blob_pair[0]]
-                    num_to_check -= 1
+    def iter_match_list(self, blob_data):
+        """
+        Generates match data for each pair of consecutive items in blob_data. blob_data
+        can be any iterable, e.g. iter_blob_data, so the blob data doesn't need to be
+        held in memory.
+        """
+        curr_item = None
+        for next_item in blob_data:
+            if curr_item is not None:
+                yield self.get_match_data(curr_item, next_item)
+            curr_item = next_item
+
+    def get_match_data(self, curr_item, next_item):
+
+        curr_frame = curr_item['frame']
+        next_frame = next_item['frame']
+        next_blob_list = next_item['blobs']
+        curr_blob_list = curr_item['blobs']
+
+        max_blobs = self.param['max_blobs']
+        index_pair_list = []
+
+        # If there aren't too many blobs - check all candidate pairs and select the best matches
+        if max_blobs is None or len(curr_blob_list) <= max_blobs:
+            curr_index, next_index = match_points(
+                    blob_positions(curr_blob_list),
+                    blob_positions(next_blob_list),
+                    self.param['max_dist'],
+                    self.param['method'],
+                    )
+            index_pair_list = list(zip(curr_index.tolist(), next_index.tolist()))
+        else:
+            self.skipped_frame_pairs.append((curr_frame, next_frame))
 
-            match_data = {'frame_pair': (curr_frame, next_frame), 'blob_pair_list': blob_pair_list}
-            match_list.append(match_data)
+        blob_pair_list = [(curr_blob_list[i], next_blob_list[j]) for i, j in index_pair_list]
 
-        return match_list
+        match_data = {
+                'frame_pair': (curr_frame, next_frame),
+                'blob_pair_list': blob_pair_list,
+                'index_pair_list': index_pair_list,
+                }
+        return match_data
 
                 
 class BlobStitcher:
     """
     Stitches together pairwise blob matches into trajectories.
+
+    Tracks are built in a single pass over the match list by following the links
+    from the blob matched in frame t+1 of one frame pair to the same blob in frame t
+    of the next frame pair. Links use the blob indices in 'index_pair_list' when the
+    match data has them (as from BlobMatcher) and otherwise compare the blobs
+    themselves. The match list is not copied or modified, track items refer to the
+    blob dictionaries in the match list.
+
+    If compact is set tracks are returned as compact Tracks (see track.Track) rather
+    than lists of {'frame', 'blob'} items.
     """
 
-    def __init__(self):
-        self.match_list_working = []
+    def __init__(self, compact=False):
+        self.compact = compact
 
     def run(self, match_list):
         track_list = self.get_track_list(match_list)
@@ -79,34 +107,114 @@ class BlobStitcher:
 
     def get_track_list(self,match_list):
         """
-        Returns list of all tracks. 
+        Returns list of all tracks ordered by the frame pair and position in the
+        frame pair's blob_pair_list at which they start.
         """
-        track_list = []
-        self.match_list_working = copy.deepcopy(match_list)
-        for index in range(len(self.match_list_working)-1): 
-            frame_pair = self.match_list_working[index]['frame_pair']
-            for blob_pair in self.match_list_working[index]['blob_pair_list']:
-                track = self.get_track(frame_pair, blob_pair,index+1) 
-                track_list.append(track)
-        self.match_list_working = []
-        return track_list
+        keyed_track_list = list(self.iter_keyed_tracks(match_list))
+        keyed_track_list.sort(key=lambda keyed_track: keyed_track[0])
+        return [track for start_key, track in keyed_track_list]
 
-    def get_track(self, frame_pair, blob_pair, index):
+    def iter_track_list(self, match_list):
         """
-        Returns track for given frame_pair, blob_pair found by search forward through the 
-        working list of all blob pair matches until no more matches are found. Blob pairs are 
-        removed from the working list of pair matches as they are added to tracks.
+        Generator which stitches blob pair matches into tracks incrementally, yielding
+        each track as soon as it ends. match_list can be any iterable of match data,
+        e.g. BlobMatcher.iter_match_list, and only the tracks still being extended are
+        kept in memory. Tracks are yielded in the order in which they end.
         """
-        track = [{'frame': frame_pair[0], 'blob': blob_pair[0]}]
-        next_frame_pair = self.match_list_working[index]['frame_pair']
-        for next_blob_pair in self.match_list_working[index]['blob_pair_list']:
-            if next_blob_pair[0] == blob_pair[1]:
-                track.extend(self.get_track(next_frame_pair, next_blob_pair, index+1))
-                self.match_list_working[index]['blob_pair_list'].remove(next_blob_pair)
-                break;
-        if len(track) == 1:
-            track.append({'frame': frame_pair[1], 'blob': blob_pair[1]})
-        return track
+        for start_key, track in self.iter_keyed_tracks(match_list):
+            yield track
+
+    def finish_track(self, keyed_track):
+        if self.compact:
+            start_key, track = keyed_track
+            return start_key, Track.from_list(track)
+        return keyed_track
+
+    def iter_keyed_tracks(self, match_list):
+        """
+        Generator yielding (start_key, track) for each track as soon as it ends, where
+        start_key is (match index, pair index) of the blob pair which starts the track.
+        """
+        active_tracks = {}
+        for match_index, match_data in enumerate(match_list):
+            curr_frame, next_frame = match_data['frame_pair']
+            blob_pair_list = match_data['blob_pair_list']
+            index_pair_list = match_data.get('index_pair_list')
+            if index_pair_list is None:
+                link_pair_list = [(blob_key(b0), blob_key(b1)) for b0, b1 in blob_pair_list]
+            else:
+                link_pair_list = index_pair_list
+
+            next_active_tracks = {}
+            for pair_index, (blob_pair, link_pair) in enumerate(zip(blob_pair_list, link_pair_list)):
+                keyed_track = active_tracks.pop(link_pair[0], None)
+                if keyed_track is None:
+                    start_key = (match_index, pair_index)
+                    keyed_track = (start_key, [{'frame': curr_frame, 'blob': blob_pair[0]}])
+                keyed_track[1].append({'frame': next_frame, 'blob': blob_pair[1]})
+                next_active_tracks[link_pair[1]] = keyed_track
+
+            # Tracks which weren't extended by this frame pair are done
+            for keyed_track in sorted(active_tracks.values(), key=lambda item: item[0]):
+                yield self.finish_track(keyed_track)
+            active_tracks = next_active_tracks
+
+        for keyed_track in sorted(active_tracks.values(), key=lambda item: item[0]):
+            yield self.finish_track(keyed_track)
+
+
+class TrackFrameIndex:
+    """
+    Index from frame numbers to the tracks which have a point in that frame. It is
+    built in a single pass over the points of all tracks, which are then sorted by
+    frame, so lookups for a frame or range of frames only visit the matching points.
+    Tracks are returned in the order they appear in track_list, which may hold list
+    tracks and Tracks.
+    """
+
+    def __init__(self, track_list):
+        self.track_list = track_list
+        track_lengths = [len(track) for track in track_list]
+        frames = track_list_column(track_list, 'frame')
+        track_indices = numpy.repeat(numpy.arange(len(track_list)), track_lengths)
+
+        # Sort points by frame then track, dropping repeated (frame, track) points
+        order = numpy.lexsort((track_indices, frames))
+        frames = frames[order]
+        track_indices = track_indices[order]
+        keep = numpy.ones(frames.shape, dtype=bool)
+        keep[1:] = (frames[1:] != frames[:-1]) | (track_indices[1:] != track_indices[:-1])
+        self.frames = frames[keep]
+        self.track_indices = track_indices[keep]
+
+    def track_indices_in_range(self, start_frame, end_frame):
+        """
+        Returns sorted array of indices of tracks with points in frames [start_frame, end_frame)
+        """
+        n0 = numpy.searchsorted(self.frames, start_frame, side='left')
+        n1 = numpy.searchsorted(self.frames, end_frame, side='left')
+        return numpy.unique(self.track_indices[n0:n1])
+
+    def tracks_in_frame(self, frame):
+        """
+        Returns list of tracks with a point in frame
+        """
+        return self.tracks_in_range(frame, frame+1)
+
+    def tracks_in_range(self, start_frame, end_frame):
+        """
+        Returns list of tracks with points in frames [start_frame, end_frame)
+        """
+        track_indices = self.track_indices_in_range(start_frame, end_frame)
+        return [self.track_list[i] for i in track_indices]
+
+    def frames_with_tracks(self, start_frame, end_frame):
+        """
+        Returns sorted array of frames in [start_frame, end_frame) which have track points
+        """
+        n0 = numpy.searchsorted(self.frames, start_frame, side='left')
+        n1 = numpy.searchsorted(self.frames, end_frame, side='left')
+        return numpy.unique(self.frames[n0:n1])
 
 
 class TrackVideoCreator:
@@ -123,11 +231,10 @@ class TrackVideoCreator:
 
     def run(self):
 
-        cap = cv2.VideoCapture(self.video_file)
-        number_of_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        frame_source = FrameSource(self.video_file)
         start_frame = self.track_list[0][0]['frame']
 
-        frame_to_tracks_dict = self.get_frame_to_tracks_dict(start_frame, number_of_frames-1)
+        frame_index = TrackFrameIndex(self.track_list)
 
         frame_number = start_frame
 
@@ -135,47 +242,12 @@ class TrackVideoCreator:
 
             print('frame: {0}'.format(frame_number))
 
-            cap.set(cv2.CAP_PROP_POS_FRAMES,frame_number)
-            ret, frame = cap.read()
-            if not ret:
+            frame = frame_source.get_frame(frame_number)
+            if frame is None:
                 break
             
-            tracks_in_frame = frame_to_tracks_dict[frame_number]
-
-            if tracks_in_frame:
-                for track in tracks_in_frame:
-
-                    # Draw line segments track points which arent from the current frame number
-                    for (item0, item1) in zip(track[:-1], track[1:]):
-                        frame0 = item0['frame']
-                        frame1 = item1['frame']
-                        if frame0 == frame_number or frame1 == frame_number:
-                            continue
-                        x0 = int(item0['blob']['centroid_x'])
-                        y0 = int(item0['blob']['centroid_y'])
-                        x1 = int(item1['blob']['centroid_x'])
-                        y1 = int(item1['blob']['centroid_y'])
-                        cv2.line(frame, (x0, y0), (x1, y1), (0,0,255))
-                        cv2.circle(frame, (x0, y0), self.param['point_radius'], (0,0,255), cv2.FILLED)
-                        cv2.circle(frame, (x1, y1), self.param['point_radius'], (0,0,255), cv2.FILLED)
-
-                    # Draw circle and line segments for point from current frame
-                    for i, item in enumerate(track):
-                        print(i)
-                        print(item)
-                        if item['frame'] == frame_number:
-                            x = item['blob']['centroid_x']
-                            y = item['blob']['centroid_y']
-                            area = item['blob']['area']
-                            radius = int(numpy.sqrt(area/numpy.pi) + self.param['circle_radius_margin'])
-                            radius = max(radius, int(self.param['circle_radius_min']))
-                            cv2.circle(frame,(int(x),int(y)), radius, (255,0,0))
-                            if i != 0:
-                                prev_item = track[i-1]
-                                self.draw_partial_line_seg(frame, item['blob'], prev_item['blob'], radius)
-                            if i !=  len(track)-1:
-                                next_item = track[i+1]
-                                self.draw_partial_line_seg(frame, item['blob'], next_item['blob'], radius)
+            tracks_in_frame = frame_index.tracks_in_frame(frame_number)
+            self.draw_tracks(frame, frame_number, tracks_in_frame)
 
             cv2.imshow('frame',frame)
 
@@ -194,32 +266,100 @@ class TrackVideoCreator:
                 frame_number += 1
 
         # Clean up
-        cap.release()
+        frame_source.close()
         cv2.destroyAllWindows()
 
-    def get_frame_to_tracks_dict(self, start_frame, end_frame):
+    def draw_tracks(self, frame, frame_number, tracks_in_frame):
+        """
+        Draws tracks with points in frame_number onto frame
+        """
+        if tracks_in_frame:
+            for track in tracks_in_frame:
+                points = track_records(track)
+                frames = points['frame']
+                x_vals = points['centroid_x'].astype(int).tolist()
+                y_vals = points['centroid_y'].astype(int).tolist()
+
+                # Draw line segments track points which arent from the current frame number
+                off_frame = (frames[:-1] != frame_number) & (frames[1:] != frame_number)
+                for i in numpy.flatnonzero(off_frame).tolist():
+                    x0, y0 = x_vals[i], y_vals[i]
+                    x1, y1 = x_vals[i+1], y_vals[i+1]
+                    cv2.line(frame, (x0, y0), (x1, y1), (0,0,255))
+                    cv2.circle(frame, (x0, y0), self.param['point_radius'], (0,0,255), cv2.FILLED)
+                    cv2.circle(frame, (x1, y1), self.param['point_radius'], (0,0,255), cv2.FILLED)
+
+                # Draw circle and line segments for point from current frame
+                for i in numpy.flatnonzero(frames == frame_number).tolist():
+                    area = float(points['area'][i])
+                    radius = int(numpy.sqrt(area/numpy.pi) + self.param['circle_radius_margin'])
+                    radius = max(radius, int(self.param['circle_radius_min']))
+                    cv2.circle(frame,(x_vals[i],y_vals[i]), radius, (255,0,0))
+                    if i != 0:
+                        self.draw_partial_line_seg(frame, points[i], points[i-1], radius)
+                    if i !=  len(points)-1:
+                        self.draw_partial_line_seg(frame, points[i], points[i+1], radius)
+
+    def render(self, output_video_name, start_frame=0, end_frame=None, fps=None):
+        """
+        Non-interactive version of run which writes video with the tracks drawn on
+        frames [start_frame, end_frame) of the input video to output_video_name. The
+        input video is only seeked once, to start_frame, and is then decoded
+        sequentially. fps defaults to that of the input video.
+        """
+        cap = cv2.VideoCapture(self.video_file)
+        if fps is None:
+            fps = cap.get(cv2.CAP_PROP_FPS)
+            if not fps > 0:
+                fps = 20.0
+        if start_frame > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES,start_frame)
+
+        frame_index = TrackFrameIndex(self.track_list)
+        vid = None
+        frame_number = start_frame
 
-        frame_to_tracks_dict = {}
+        while end_frame is None or frame_number < end_frame:
+            ret, frame = cap.read()
+            if not ret:
+                break
 
-        # Empty list until start_frame
-        for i in range(start_frame):
-            frame_to_tracks_dict[i] = []
+            tracks_in_frame = frame_index.tracks_in_frame(frame_number)
+            self.draw_tracks(frame, frame_number, tracks_in_frame)
 
-        # Loop over frames and add all tracks which contains frame to list for 
-        # that frame.
-        for i in range(start_frame, end_frame+1):
-            frame_to_tracks_dict[i] = []
-            for track in self.track_list:
-                if any([i==item['frame'] for item in track]):
-                    frame_to_tracks_dict[i].append(track)
+            if vid is None:
+                vid = cv2.VideoWriter(
+                        output_video_name,
+                        0x00000021,    # hack for cv2.VideoWriter_fourcc(*'MP4V')
+                        fps,
+                        (frame.shape[1], frame.shape[0]),
+                        )
+            vid.write(frame)
+            frame_number += 1
 
+        # Clean up
+        cap.release()
+        if vid is not None:
+            vid.release()
+
+    def get_frame_to_tracks_dict(self, start_frame, end_frame):
+        """
+        Returns dictionary mapping each frame in [0, end_frame] to the list of tracks
+        with a point in that frame. Frames before start_frame map to empty lists.
+        """
+        frame_index = TrackFrameIndex(self.track_list)
+        frame_to_tracks_dict = {}
+        for i in range(end_frame+1):
+            frame_to_tracks_dict[i] = []
+        for i in frame_index.frames_with_tracks(start_frame, end_frame+1):
+            frame_to_tracks_dict[i] = frame_index.tracks_in_frame(i)
         return frame_to_tracks_dict
 
     def draw_partial_line_seg(self,frame, blob0, blob1, radius):
-        x0 = blob0['centroid_x']
-        y0 = blob0['centroid_y']
-        x1 = blob1['centroid_x']
-        y1 = blob1['centroid_y']
+        x0 = float(blob0['centroid_x'])
+        y0 = float(blob0['centroid_y'])
+        x1 = float(blob1['centroid_x'])
+        y1 = float(blob1['centroid_y'])
 
         dx = x1 - x0
         dy = y1 - y0
@@ -238,66 +378,73 @@ class TrackVideoCreator:
 
 
 def filter_outlying_segments(track_list, multiplier=1, use_mad=False, filter_floor_pix=50):
-    
+    """
+    Splits tracks at outlying steps, i.e. steps whose length differs from the track's
+    mean step length by more than max(multiplier*std, filter_floor_pix), or from the
+    median by more than max(multiplier*MAD, filter_floor_pix) if use_mad is set.
+    Pieces of a single point are dropped. track_list may hold list tracks and
+    Tracks, pieces of a Track are Tracks.
+
+    Returns list of new tracks, list of flags which are True for tracks which are
+    pieces of a split track, and list of the tracks which were split.
+
+    All tracks are handled at once: the positions of tracks longer than two points
+    are concatenated, the per track statistics are computed with segmented reductions
+    and the split points are found with index arithmetic, so only the slicing of the
+    split tracks is done per track.
+    """
+    track_lengths = numpy.array([len(track) for track in track_list], dtype=numpy.int64)
+    long_tracks = numpy.flatnonzero(track_lengths > 2)
+
+    cut_dict = {}
+    if len(long_tracks) > 0:
+        x_vals, y_vals = track_positions([track_list[i] for i in long_tracks])
+
+        # Steps of each track are contiguous in step_array, track k's steps start at
+        # step_starts[k]. Differences across track boundaries are dropped.
+        lengths = track_lengths[long_tracks]
+        point_starts = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+        step_counts = lengths - 1
+        step_starts = point_starts - numpy.arange(len(lengths))
+        step_array = numpy.sqrt(numpy.diff(x_vals)**2 + numpy.diff(y_vals)**2)
+        step_array = numpy.delete(step_array, point_starts[1:] - 1)
+        step_track = numpy.repeat(numpy.arange(len(lengths)), step_counts)
+
+        if use_mad:
+            center = segmented_median(step_array, step_track, step_starts, step_counts)
+            abs_dev = numpy.abs(step_array - center[step_track])
+            spread = segmented_median(abs_dev, step_track, step_starts, step_counts)
+        else:
+            center = numpy.add.reduceat(step_array, step_starts)/step_counts
+            abs_dev = numpy.abs(step_array - center[step_track])
+            spread = numpy.sqrt(numpy.add.reduceat(abs_dev**2, step_starts)/step_counts)
+        threshold = numpy.maximum(spread*multiplier, filter_floor_pix)
+
+        # Track is cut before the point following each flagged step
+        flagged = numpy.flatnonzero(abs_dev > threshold[step_track])
+        flagged_track = step_track[flagged]
+        cut_index = flagged - step_starts[flagged_track] + 1
+        split_tracks, first_cut = numpy.unique(flagged_track, return_index=True)
+        for k, cuts in zip(split_tracks, numpy.split(cut_index, first_cut[1:])):
+            cut_dict[long_tracks[k]] = cuts.tolist()
+
     new_track_list = []
     change_flag_list = []
-
     debug_track_list = []
 
     for i, track in enumerate(track_list):
-
-        x_vals =[]
-        y_vals =[]
-        flagged_indices = []
-
-        if len(track) <= 2:
-            change_flag_list.append(False)
+        cuts = cut_dict.get(i)
+        if cuts is None:
             new_track_list.append(track)
-            continue
-
-        x_vals = [item['blob']['centroid_x'] for item in track]
-        y_vals = [item['blob']['centroid_y'] for item in track]
-
-        diff_x = numpy.array(numpy.diff(x_vals))
-        diff_y = numpy.array(numpy.diff(y_vals))
-
-        step_array = (numpy.sqrt(diff_x**2 + diff_y**2))
-        
-        if use_mad:
-            intrapair_mad = get_mad(step_array)
-            intrapair_median = numpy.median(step_array)
-        else:
-            intrapair_step_sigma = numpy.std(step_array)
-            intrapair_step_mean = numpy.mean(step_array)
-
-        for index, value in enumerate(step_array):
-            if use_mad:
-                if numpy.abs(value - intrapair_median) > max(intrapair_mad*multiplier, filter_floor_pix):
-                    flagged_indices.append(index+1)
-            else:
-                if numpy.abs(value - intrapair_step_mean) > max(intrapair_step_sigma*multiplier,filter_floor_pix):
-                    flagged_indices.append(index+1)
-                    print('i: {0}, avg: {1:1.2f}, std: {2:1.2f}, max: {3:1.2f}, {4}'.format(i,intrapair_step_mean, intrapair_step_sigma, step_array.max(), len(track)))
-
-        if len(flagged_indices) == 0:
             change_flag_list.append(False)
-            new_track_list.append(track)
             continue
-
         debug_track_list.append(track)
-    
-        flagged_indices.insert(0,0)
-        flagged_indices.append(len(track))
-
-
-        for n, m in zip(flagged_indices[:-1], flagged_indices[1:]):
-            new_track = track[n:m]
-            if len(new_track) > 1:
-                new_track_list.append(new_track)
+        for n, m in zip([0] + cuts, cuts + [len(track)]):
+            if m - n > 1:
+                new_track_list.append(track[n:m])
                 change_flag_list.append(True)
 
     return new_track_list, change_flag_list, debug_track_list
-        
 
 
 # Utility functions
@@ -307,9 +454,42 @@ def get_mad(data):
     median = numpy.median(data)
     return numpy.median(numpy.abs(data - median))
 
+def segmented_median(values, segment, starts, counts):
+    """
+    Returns median of each segment of values, where segment gives the segment of
+    each value, segments are contiguous and start at starts and have counts values.
+    Segments must not be empty.
+    """
+    sorted_values = values[numpy.lexsort((values, segment))]
+    lower = sorted_values[starts + (counts - 1)//2]
+    upper = sorted_values[starts + counts//2]
+    return (lower + upper)/2.0
+
+def track_positions(track_list):
+    """
+    Returns arrays of x and y positions of all points of the tracks in track_list,
+    concatenated in order.
+    """
+    return track_list_column(track_list, 'centroid_x'), track_list_column(track_list, 'centroid_y')
+
 def blob_position(blob):
     return blob['centroid_x'], blob['centroid_y']
 
+def blob_key(blob):
+    """
+    Returns hashable key for blob dictionary
+    """
+    return tuple(sorted(blob.items()))
+
+def blob_positions(blob_list):
+    """
+    Returns (n,2) array of blob centroids
+    """
+    pos = numpy.zeros((len(blob_list),2))
+    pos[:,0] = [blob['centroid_x'] for blob in blob_list]
+    pos[:,1] = [blob['centroid_y'] for blob in blob_list]
+    return pos
+
 def blob_distance(blob_0, blob_1):
     x0, y0 = blob_position(blob_0)
     x1, y1 = blob_position(blob_1)
@@ -0,0 +1,183 @@
+from __future__ import print_function
+import json
+import time
+import threading
+import collections
+
+
+class TrackerStats:
+    """
+    Timing and throughput statistics for a tracking run.
+
+    Time is accumulated per stage with add, which is called at the end of each stage
+    with the time the stage started and returns the current time so that consecutive
+    stages can be timed with one call each:
+
+        t = time.time()
+        ret, frame = cap.read()
+        t = stats.add('decode', t)
+        frame = preprocess(frame)
+        t = stats.add('preprocess', t)
+
+    frame_done is called once per frame when all its stages are complete. It keeps a
+    rolling frames per second over the last fps_window frames and prints a progress
+    line at most every progress_interval seconds (None for no progress output). If
+    log_file_name is given a snapshot (see snapshot) is appended to it as one line of
+    json every log_interval seconds and when the stats are closed.
+
+    Stages may run in different threads, e.g. in the pipeline execution mode, as long
+    as each stage is only timed from one thread.
+    """
+
+    stage_names = (
+            'decode',
+            'preprocess',
+            'background',
+            'blob_find',
+            'render',
+            'video_write',
+            'blob_write',
+            'tracking',
+            )
+
+    def __init__(self, number_of_frames=None, fps_window=100, progress_interval=5.0, log_file_name=None, log_interval=10.0):
+        self.number_of_frames = number_of_frames
+        self.progress_interval = progress_interval
+        self.log_interval = log_interval
+        self.stage_time = collections.OrderedDict((name, 0.0) for name in self.stage_names)
+        self.stage_count = dict((name, 0) for name in self.stage_names)
+        self.queues = collections.OrderedDict()
+        self.frame_count = 0
+        self.last_frame = None
+        self.frame_times = collections.deque(maxlen=fps_window)
+        self.lock = threading.Lock()
+
+        self.start_time = time.time()
+        self.last_progress_time = self.start_time
+        self.last_log_time = self.start_time
+        self.log_fid = None
+        if log_file_name is not None:
+            self.log_fid = open(log_file_name, 'w')
+
+    def add(self, stage, start_time):
+        """
+        Adds time since start_time to stage. Returns current time.
+        """
+        now = time.time()
+        self.stage_time[stage] += now - start_time
+        self.stage_count[stage] += 1
+        return now
+
+    def add_queue(self, name, queue):
+        """
+        Adds queue (anything with a qsize method) whose depth is reported
+        """
+        self.queues[name] = queue
+
+    def frame_done(self, frame):
+        now = time.time()
+        with self.lock:
+            self.frame_count += 1
+            self.last_frame = frame
+            self.frame_times.append(now)
+            report_progress = (
+                    self.progress_interval is not None and
+                    now - self.last_progress_time >= self.progress_interval
+                    )
+            if report_progress:
+                self.last_progress_time = now
+            write_log = self.log_fid is not None and now - self.last_log_time >= self.log_interval
+            if write_log:
+                self.last_log_time = now
+        if report_progress:
+            print(self.progress_line())
+        if write_log:
+            self.write_log()
+
+    def fps(self):
+        """
+        Returns frames per second since the start of the run
+        """
+        elapsed = time.time() - self.start_time
+        if elapsed <= 0:
+            return 0.0
+        return self.frame_count/elapsed
+
+    def rolling_fps(self):
+        """
+        Returns frames per second over the last fps_window frames
+        """
+        with self.lock:
+            if len(self.frame_times) < 2:
+                return 0.0
+            dt = self.frame_times[-1] - self.frame_times[0]
+            num_frames = len(self.frame_times) - 1
+        if dt <= 0:
+            return 0.0
+        return num_frames/dt
+
+    def queue_depths(self):
+        return collections.OrderedDict((name, queue.qsize()) for name, queue in self.queues.items())
+
+    def snapshot(self):
+        """
+        Returns dictionary of current stats: elapsed time, frame counts, overall and
+        rolling fps, total time, call count and mean time (ms) of each stage, and queue
+        depths.
+        """
+        stages = collections.OrderedDict()
+        for name, stage_time in self.stage_time.items():
+            count = self.stage_count[name]
+            stages[name] = {
+                    'time': stage_time,
+                    'count': count,
+                    'ms_per_call': 1000.0*stage_time/count if count > 0 else 0.0,
+                    }
+        return collections.OrderedDict([
+            ('time', time.time()),
+            ('elapsed', time.time() - self.start_time),
+            ('frames', self.frame_count),
+            ('last_frame', self.last_frame),
+            ('number_of_frames', self.number_of_frames),
+            ('fps', self.fps()),
+            ('rolling_fps', self.rolling_fps()),
+            ('stages', stages),
+            ('queues', self.queue_depths()),
+            ])
+
+    def progress_line(self):
+        if self.number_of_frames:
+            frames = '{0}/{1}'.format(self.frame_count, self.number_of_frames)
+        else:
+            frames = '{0}'.format(self.frame_count)
+        line = 'frames: {0}, fps: {1:.1f}, rolling fps: {2:.1f}'.format(frames, self.fps(), self.rolling_fps())
+        depths = self.queue_depths()
+        if depths:
+            line += ', queues: ' + ', '.join('{0} {1}'.format(name, depth) for name, depth in depths.items())
+        return line
+
+    def summary(self):
+        """
+        Returns multi-line table of time spent in each stage
+        """
+        total_time = sum(self.stage_time.values())
+        lines = ['stage          total (s)    ms/call   share']
+        for name, stage_time in self.stage_time.items():
+            count = self.stage_count[name]
+            if count == 0:
+                continue
+            share = 100.0*stage_time/total_time if total_time > 0 else 0.0
+            lines.append('{0:<12s} {1:11.2f} {2:10.2f} {3:6.1f}%'.format(name, stage_time, 1000.0*stage_time/count, share))
+        lines.append('frames: {0}, elapsed: {1:.2f}s, fps: {2:.1f}'.format(
+            self.frame_count, time.time() - self.start_time, self.fps()))
+        return '\n'.join(lines)
+
+    def write_log(self):
+        self.log_fid.write(json.dumps(self.snapshot()) + '\n')
+        self.log_fid.flush()
+
+    def close(self):
+        if self.log_fid is not None:
+            self.write_log()
+            self.log_fid.close()
+            self.log_fid = None